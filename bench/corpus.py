@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Synthetic corpus generator for nav benchmarks.
+
+Usage:
+  corpus.py <dst> [--count=N] [--size=WxH] [--format=FORMAT] [--seed=SEED]
+
+Options:
+  -h --help         Show this help message and exit
+  --count=N         Number of files [default: 20]
+  --size=WxH        Dimensions of every file [default: 1440x3000]
+  --format=FORMAT   png, jpg or psd [default: png]
+  --seed=SEED       Seed for the generated content [default: 1]
+
+Examples:
+  corpus.py /tmp/corpus --count 300 --format psd
+  corpus.py /tmp/mobile --count 20 --size 750x20000
+
+PNG and PSD files are written without dependencies and stream row by
+row, so very tall mobile screens do not need the whole canvas in memory.
+JPEG files are real when Pillow is installed; otherwise they only carry
+valid headers, which is enough for nav and the fake converter but not
+for ImageMagick.
+"""
+
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import io
+import random
+import struct
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from docopt import docopt
+
+
+def getRows(width, height, seed):
+    """Yields height RGB rows that compress roughly like UI screens: flat
+    bands with some noisy areas."""
+    rnd = random.Random(seed)
+    noise = bytes(bytearray(rnd.getrandbits(8) for i in range(width * 3 * 4)))
+    band = None
+    for y in range(height):
+        if y % 64 == 0:
+            color = bytearray([rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)])
+            flat = bytes(color * width)
+            offset = rnd.randrange(width * 3)
+            band = noise[offset:offset + width * 3] if rnd.random() < 0.3 else flat
+            if len(band) < width * 3:
+                band = flat
+        yield band
+
+
+def writePng(path, width, height, seed):
+    def chunk(f, kind, data):
+        f.write(struct.pack(">L", len(data)) + kind + data)
+        f.write(struct.pack(">L", zlib.crc32(kind + data) & 0xffffffff))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        chunk(f, b"IHDR", struct.pack(">LLBBBBB", width, height, 8, 2, 0, 0, 0))
+        compressor = zlib.compressobj(6)
+        pending = []
+        for row in getRows(width, height, seed):
+            pending.append(compressor.compress(b"\x00" + row))
+            if sum(len(p) for p in pending) > 1 << 16:
+                chunk(f, b"IDAT", b"".join(pending))
+                pending = []
+        pending.append(compressor.flush())
+        chunk(f, b"IDAT", b"".join(pending))
+        chunk(f, b"IEND", b"")
+
+
+def getPreview(width, height, seed):
+    """JPEG data of a preview at most 160 pixels wide or tall, as
+    Photoshop embeds in image resource 1036. None without Pillow."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    scale = 160 / max(width, height)
+    size = max(1, int(width * scale)), max(1, int(height * scale))
+    image = Image.frombytes("RGB", size, b"".join(getRows(size[0], size[1], seed)))
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=80)
+    return image.size, buf.getvalue()
+
+
+def writePsd(path, width, height, seed):
+    """Writes an RGB PSD with a raw (uncompressed) composite image and,
+    with Pillow, an embedded JPEG preview."""
+    resources = b""
+    preview = getPreview(width, height, seed)
+    if preview is not None:
+        (previewWidth, previewHeight), data = preview
+        header = struct.pack(">LLLLLLHH", 1, previewWidth, previewHeight, (previewWidth * 24 + 31) // 32 * 4, 0, len(data), 24, 1)
+        resource = header + data + b"\x00" * (len(data) % 2)
+        resources = b"8BIM" + struct.pack(">HHL", 1036, 0, len(header) + len(data)) + resource
+
+    with open(path, "wb") as f:
+        f.write(b"8BPS" + struct.pack(">H6xHLLHH", 1, 3, height, width, 8, 3))
+        # Color mode data, image resources, layer and mask info
+        f.write(struct.pack(">L", 0))
+        f.write(struct.pack(">L", len(resources)) + resources)
+        f.write(struct.pack(">L", 0))
+        f.write(struct.pack(">H", 0))
+        # Planar channels: every red row, then green, then blue
+        for channel in range(3):
+            for row in getRows(width, height, seed):
+                f.write(row[channel::3])
+
+
+def writeJpeg(path, width, height, seed):
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+
+    if Image is not None:
+        data = b"".join(getRows(width, height, seed))
+        Image.frombytes("RGB", (width, height), data).save(path, "JPEG", quality=85)
+        return
+
+    with open(path, "wb") as f:
+        f.write(b"\xff\xd8")
+        f.write(b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+        f.write(b"\xff\xc0" + struct.pack(">HBHHB", 17, 8, height, width, 3))
+        f.write(b"\x01\x11\x00\x02\x11\x01\x03\x11\x01")
+        f.write(b"\xff\xd9")
+
+
+WRITERS = {
+    'png': writePng,
+    'psd': writePsd,
+    'jpg': writeJpeg
+}
+
+
+def createCorpus(directory, count, width, height, fileFormat, seed=1):
+    """Writes count files named "screen-N.<format>" and returns their paths."""
+    if fileFormat not in WRITERS:
+        raise ValueError("Unknown format {0}, use one of: {1}".format(fileFormat, ", ".join(sorted(WRITERS))))
+    if os.path.isdir(directory) == False:
+        os.makedirs(directory)
+
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "screen-{0}.{1}".format(i + 1, fileFormat))
+        WRITERS[fileFormat](path, width, height, seed + i)
+        paths.append(path)
+    return paths
+
+
+def parseSize(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    width, height = parseSize(args['--size'])
+    paths = createCorpus(args['<dst>'], int(args['--count']), width, height, args['--format'], int(args['--seed']))
+    print("{0} files written to {1}".format(len(paths), args['<dst>']))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Stand-in for the ImageMagick `convert` binary used by the benchmarks.
+
+It understands the command lines nav builds (single conversions, render
+plans with `( +clone ... -write ... +delete )` groups, --batch runs and
+embedded previews piped through stdin),
+writes a placeholder file for every output and sleeps to simulate the
+cost of the real thing:
+
+  NAVZEN_FAKE_STARTUP_MS    Fixed cost of every process [default: 30]
+  NAVZEN_FAKE_DECODE_MS     Cost per decoded megapixel [default: 15]
+  NAVZEN_FAKE_ENCODE_MS     Cost per encoded megapixel [default: 10]
+
+Every call is appended as one JSON line to $NAVZEN_FAKE_LOG, when set.
+"""
+
+from __future__ import print_function
+from __future__ import division
+import os
+import re
+import sys
+import json
+import time
+import struct
+
+
+def getMilliseconds(name, default):
+    return float(os.environ.get(name, default)) / 1000
+
+
+def getSize(path):
+    """(width, height) from the header of a PNG, GIF, JPEG or PSD file.
+    "jpeg:-" reads JPEG data from stdin."""
+    if path == "jpeg:-":
+        head = getattr(sys.stdin, "buffer", sys.stdin).read()
+    else:
+        with open(path, "rb") as f:
+            head = f.read(64 * 1024)
+    if head[:4] == b"8BPS":
+        height, width = struct.unpack(">LL", head[14:22])
+        return width, height
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">LL", head[16:24])
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return struct.unpack("<HH", head[6:10])
+    pos = 2
+    while pos + 9 <= len(head):
+        marker = ord(head[pos+1:pos+2])
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack(">HH", head[pos+5:pos+9])
+            return width, height
+        pos += 2 + struct.unpack(">H", head[pos+2:pos+4])[0]
+    raise ValueError("unknown image {0}".format(path))
+
+
+def resize(size, geometry):
+    width, height = size
+    match = re.match(r"(\d*\.?\d*)(?:x(\d*))?(%?)", geometry)
+    if match.group(3):
+        scale = float(match.group(1)) / 100
+        return max(1, int(width * scale)), max(1, int(height * scale))
+    if match.group(1):
+        scale = int(match.group(1)) / width
+        if match.group(2):
+            scale = min(scale, int(match.group(2)) / height)
+        return max(1, int(width * scale)), max(1, int(height * scale))
+    if match.group(2):
+        scale = int(match.group(2)) / height
+        return max(1, int(width * scale)), max(1, int(height * scale))
+    return size
+
+
+def crop(size, geometry):
+    match = re.match(r"(\d+)x(\d+)\+(\d+)\+(\d+)", geometry)
+    if match is None:
+        return size
+    width, height, x, y = [int(g) for g in match.groups()]
+    return max(1, min(width, size[0] - x)), max(1, min(height, size[1] - y))
+
+
+def writeOutput(path, size):
+    """Placeholder about the size a compressed screen would have."""
+    pixels = size[0] * size[1]
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + struct.pack(">L4sLL", 13, b"IHDR", size[0], size[1]))
+        f.write(b"\x00" * max(64, pixels // 8))
+    time.sleep(pixels / 1e6 * getMilliseconds("NAVZEN_FAKE_ENCODE_MS", 10))
+
+
+def run(argv):
+    time.sleep(getMilliseconds("NAVZEN_FAKE_STARTUP_MS", 30))
+
+    output = argv[-1]
+    stack = [[]]
+    pending = []
+    decoded = 0
+    outputs = []
+    i = 0
+    while i < len(argv) - 1:
+        arg = argv[i]
+        images = stack[-1]
+        if arg == "(":
+            stack.append([])
+        elif arg == ")":
+            closed = stack.pop()
+            stack[-1].extend(closed)
+        elif arg in ("-resize", "-crop"):
+            operation = resize if arg == "-resize" else crop
+            if images:
+                images[-1] = operation(images[-1], argv[i+1])
+            else:
+                pending.append((operation, argv[i+1]))
+            i += 1
+        elif arg in ("-quality", "-define"):
+            i += 1
+        elif arg == "-write":
+            writeOutput(argv[i+1], images[-1])
+            outputs.append(argv[i+1])
+            i += 1
+        elif arg == "+clone":
+            images.append(stack[-2][-1])
+        elif arg == "+delete":
+            images.pop()
+        elif arg == "+repage":
+            pass
+        else:
+            size = getSize(re.sub(r"\[\d+\]$", "", arg))
+            decoded += size[0] * size[1]
+            time.sleep(size[0] * size[1] / 1e6 * getMilliseconds("NAVZEN_FAKE_DECODE_MS", 15))
+            for operation, geometry in pending:
+                size = operation(size, geometry)
+            pending = []
+            images.append(size)
+        i += 1
+
+    if output != "null:":
+        writeOutput(output, stack[-1][-1])
+        outputs.append(output)
+
+    log = os.environ.get("NAVZEN_FAKE_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write(json.dumps({'pid': os.getpid(), 'decoded': decoded, 'outputs': len(outputs)}) + "\n")
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
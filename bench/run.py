@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Benchmarks for nav create.
+
+Usage:
+  run.py [<scenario>...] [--count=N] [--jobs=JOBS] [--nav-args=ARGS] [--json=FILE] [--keep]
+
+Options:
+  -h --help         Show this help message and exit
+  --count=N         Files per scenario, the index scenario uses 20 times more [default: 20]
+  --jobs=JOBS       Value passed to nav --jobs [default: 1]
+  --nav-args=ARGS   Extra arguments for nav create, e.g. "--batch" [default: ]
+  --json=FILE       Also write the results as JSON
+  --keep            Keep the corpora and output directories
+
+Scenarios:
+  desktop           PNG screens, one image and thumb each
+  psd               PSD screens
+  mobile            Very tall PNG screens cut in slices (-m)
+  index             Many small files, dominated by thumbs and index
+  rebuild           Desktop build, then a rebuild after one file changes
+  startup           Cold start: nav --version and nav --help, best of --count runs
+  serve             PSD screens with nav serve: time to the index and to the first screen
+
+Every scenario runs nav.py in a fresh process with the fake converter
+(fakeconvert.py) in place of ImageMagick and reports wall time, the
+number of converter processes, bytes of the output files the (last)
+run created or replaced and the peak RSS of nav and its children.
+"""
+
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import signal
+import tempfile
+import subprocess
+
+BENCH_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+NAV_FILE_PATH = os.path.join(os.path.dirname(BENCH_DIR_PATH), "nav.py")
+
+sys.path.insert(0, os.path.dirname(BENCH_DIR_PATH))
+sys.path.insert(0, BENCH_DIR_PATH)
+from docopt import docopt
+import corpus
+
+
+# name: (file format, size, count multiplier, nav arguments)
+SCENARIOS = [
+    ('desktop', 'png', (1440, 3000), 1, []),
+    ('psd', 'psd', (1440, 3000), 1, []),
+    ('mobile', 'png', (750, 12000), 1, ['-m']),
+    ('index', 'png', (320, 480), 20, []),
+    ('rebuild', 'png', (1440, 3000), 1, []),
+    ('startup', None, None, 1, []),
+    ('serve', 'psd', (1440, 3000), 1, [])
+]
+
+
+class Bench(object):
+
+    def __init__(self, workDirectory, jobs, navArgs):
+        self.workDirectory = workDirectory
+        self.jobs = jobs
+        self.navArgs = navArgs
+        self.binDirectory = os.path.join(workDirectory, "bin")
+        self.log = os.path.join(workDirectory, "convert.log")
+        self.installConverter()
+
+    def installConverter(self):
+        """Puts a `convert` that runs fakeconvert.py first in the PATH."""
+        os.makedirs(self.binDirectory)
+        wrapper = os.path.join(self.binDirectory, "convert")
+        with open(wrapper, "w") as f:
+            f.write("#!/bin/sh\nexec '{0}' '{1}' \"$@\"\n".format(sys.executable, os.path.join(BENCH_DIR_PATH, "fakeconvert.py")))
+        os.chmod(wrapper, 0o755)
+
+    def runNav(self, args):
+        """Runs nav and returns its wall time, converter calls and peak RSS."""
+        if os.path.isfile(self.log):
+            os.remove(self.log)
+        env = dict(os.environ)
+        env['PATH'] = self.binDirectory + os.pathsep + env.get('PATH', '')
+        env['NAVZEN_FAKE_LOG'] = self.log
+
+        start = time.time()
+        process = subprocess.Popen([sys.executable, NAV_FILE_PATH] + args, env=env, stdout=subprocess.DEVNULL)
+        pid, status, rusage = os.wait4(process.pid, 0)
+        wall = time.time() - start
+        if status != 0:
+            raise RuntimeError("nav {0} failed with status {1}".format(" ".join(args), status))
+
+        calls = 0
+        if os.path.isfile(self.log):
+            with open(self.log) as f:
+                calls = sum(1 for line in f)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return {'wall': wall, 'subprocesses': calls, 'peakRss': rss}
+
+    def runStartup(self, count):
+        """Best wall time of nav --version (wall) and nav --help (helpWall)."""
+        result = {'subprocesses': 0, 'peakRss': 0}
+        for key, args in (('wall', ['--version']), ('helpWall', ['--help'])):
+            runs = [self.runNav(args) for i in range(count)]
+            result[key] = min(run['wall'] for run in runs)
+            result['peakRss'] = max([result['peakRss']] + [run['peakRss'] for run in runs])
+        return result
+
+    def runServe(self, source, output, args):
+        """Starts nav serve and times the first index page (wall) and the
+        html and image of the first screen (screenWall)."""
+        import socket
+        import urllib.request
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        env = dict(os.environ)
+        env['PATH'] = self.binDirectory + os.pathsep + env.get('PATH', '')
+        env['NAVZEN_FAKE_LOG'] = self.log
+        url = "http://127.0.0.1:{0}/".format(port)
+
+        start = time.time()
+        process = subprocess.Popen([sys.executable, NAV_FILE_PATH, 'serve', source, output, '--port', str(port)] + args, env=env, stdout=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(url).read()
+                    break
+                except OSError:
+                    if process.poll() is not None:
+                        raise RuntimeError("nav serve failed with status {0}".format(process.returncode))
+                    time.sleep(0.01)
+            wall = time.time() - start
+
+            first = os.path.splitext(sorted(os.listdir(source))[0])[0]
+            start = time.time()
+            urllib.request.urlopen(url + urllib.request.quote(first + ".html")).read()
+            urllib.request.urlopen(url + urllib.request.quote(first + ".png")).read()
+            screenWall = time.time() - start
+        finally:
+            process.send_signal(signal.SIGINT)
+            pid, status, rusage = os.wait4(process.pid, 0)
+
+        calls = 0
+        if os.path.isfile(self.log):
+            with open(self.log) as f:
+                calls = sum(1 for line in f)
+        rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return {'wall': wall, 'screenWall': screenWall, 'subprocesses': calls, 'peakRss': rss}
+
+    def run(self, name, fileFormat, size, count, args):
+        if name == 'startup':
+            result = self.runStartup(count)
+            result['scenario'] = name
+            result['files'] = 0
+            result['bytesWritten'] = 0
+            return result
+
+        source = os.path.join(self.workDirectory, name)
+        output = os.path.join(self.workDirectory, name + "-out")
+        paths = corpus.createCorpus(source, count, size[0], size[1], fileFormat)
+
+        navArgs = ['create', source, output, '-i', fileFormat, '--jobs', str(self.jobs)] + args + self.navArgs
+        before = getDirectorySnapshot(output)
+        if name == 'serve':
+            if os.path.isfile(self.log):
+                os.remove(self.log)
+            result = self.runServe(source, output, ['-i', fileFormat, '--jobs', str(self.jobs)] + args)
+        else:
+            result = self.runNav(navArgs)
+
+        if name == 'rebuild':
+            corpus.createCorpus(source, 1, size[0], size[1], fileFormat, seed=count + 1)
+            before = getDirectorySnapshot(output)
+            result = self.runNav(navArgs)
+            result['changed'] = 1
+
+        result['scenario'] = name
+        result['files'] = len(paths)
+        result['bytesWritten'] = getBytesWritten(before, getDirectorySnapshot(output))
+        return result
+
+
+def getDirectorySnapshot(directory):
+    """(inode, size, mtime) of every file under directory, by path."""
+    snapshot = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            snapshot[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+def getBytesWritten(before, after):
+    """Size of the files a run created or replaced. Outputs that nav left
+    alone because they came out the same keep their inode and mtime and
+    don't count, so a rebuild only reports what it really rewrote."""
+    return sum(stat[1] for path, stat in after.items() if before.get(path) != stat)
+
+
+def printTable(results):
+    print("{0:<10} {1:>6} {2:>9} {3:>8} {4:>12} {5:>10}".format("scenario", "files", "wall (s)", "procs", "written (MB)", "rss (MB)"))
+    for r in results:
+        print("{0:<10} {1:>6} {2:>9.2f} {3:>8} {4:>12.1f} {5:>10.1f}".format(
+            r['scenario'], r['files'], r['wall'], r['subprocesses'], r['bytesWritten'] / 1e6, r['peakRss'] / 1e6))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    names = args['<scenario>'] or [s[0] for s in SCENARIOS]
+    unknown = set(names) - set(s[0] for s in SCENARIOS)
+    if unknown:
+        sys.exit("Unknown scenario: {0}".format(", ".join(sorted(unknown))))
+
+    workDirectory = tempfile.mkdtemp(prefix="navbench-")
+    try:
+        bench = Bench(workDirectory, args['--jobs'], shlex.split(args['--nav-args']))
+        results = []
+        for name, fileFormat, size, multiplier, navArgs in SCENARIOS:
+            if name in names:
+                results.append(bench.run(name, fileFormat, size, int(args['--count']) * multiplier, navArgs))
+        printTable(results)
+        if args['--json']:
+            with open(args['--json'], "w") as f:
+                json.dump(results, f, indent=1)
+    finally:
+        if args['--keep']:
+            print("Files kept in {0}".format(workDirectory))
+        else:
+            shutil.rmtree(workDirectory)
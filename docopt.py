@@ -6,13 +6,21 @@
  * Copyright (c) 2013 Vladimir Keleshev, vladimir@keleshev.com
 
 """
+import os
 import sys
 import re
+import marshal
 
 
 __all__ = ['docopt']
 __version__ = '0.6.1'
 
+# Bump when the layout written by dump_compiled changes
+CACHE_VERSION = 1
+# Compiled usage by doc hash, kept as marshal data so that every call
+# unpacks fresh pattern objects
+_compiled = {}
+
 
 class DocoptLanguageError(Exception):
 
@@ -46,54 +54,53 @@ class Pattern(object):
         """Make pattern-tree tips point to same object if they are equal."""
         if not hasattr(self, 'children'):
             return self
-        uniq = list(set(self.flat())) if uniq is None else uniq
+        if uniq is None:
+            uniq = {}
+            for leaf in self.flat():
+                uniq.setdefault(leaf, leaf)
         for i, child in enumerate(self.children):
             if not hasattr(child, 'children'):
-                assert child in uniq
-                self.children[i] = uniq[uniq.index(child)]
+                self.children[i] = uniq[child]
             else:
                 child.fix_identities(uniq)
 
     def fix_repeating_arguments(self):
         """Fix elements that should accumulate/increment values."""
-        either = [list(child.children) for child in transform(self).children]
-        for case in either:
-            for e in [child for child in case if case.count(child) > 1]:
-                if type(e) is Argument or type(e) is Option and e.argcount:
-                    if e.value is None:
-                        e.value = []
-                    elif type(e.value) is not list:
-                        e.value = e.value.split()
-                if type(e) is Command or type(e) is Option and e.argcount == 0:
-                    e.value = 0
+        for e, count in list(self.max_counts().items()):
+            if count < 2:
+                continue
+            if type(e) is Argument or type(e) is Option and e.argcount:
+                if e.value is None:
+                    e.value = []
+                elif type(e.value) is not list:
+                    e.value = e.value.split()
+            if type(e) is Command or type(e) is Option and e.argcount == 0:
+                e.value = 0
         return self
 
+    def max_counts(self):
+        """Most times each tip can appear in a single usage case.
 
-def transform(pattern):
-    """Expand pattern into an (almost) equivalent one, but with single Either.
+        Sequences add up their children, an Either takes the largest
+        count among its branches and a repetition counts twice, so the
+        cases are never expanded one by one.
 
-    Example: ((-a | -b) (-c | -d)) => (-a -c | -a -d | -b -c | -b -d)
-    Quirks: [-a] => (-a), (-a...) => (-a -a)
+        Example: ((-a | -b) -a...) => {-a: 3, -b: 1}
+        Quirks: [-a] => (-a), (-a...) => (-a -a)
 
-    """
-    result = []
-    groups = [[pattern]]
-    while groups:
-        children = groups.pop(0)
-        parents = [Required, Optional, OptionsShortcut, Either, OneOrMore]
-        if any(t in map(type, children) for t in parents):
-            child = [c for c in children if type(c) in parents][0]
-            children.remove(child)
-            if type(child) is Either:
-                for c in child.children:
-                    groups.append([c] + children)
-            elif type(child) is OneOrMore:
-                groups.append(child.children * 2 + children)
-            else:
-                groups.append(child.children + children)
-        else:
-            result.append(children)
-    return Either(*[Required(*e) for e in result])
+        """
+        if not hasattr(self, 'children'):
+            return {self: 1}
+        counts = {}
+        for child in self.children:
+            for e, count in child.max_counts().items():
+                if type(self) is Either:
+                    counts[e] = max(counts.get(e, 0), count)
+                else:
+                    counts[e] = counts.get(e, 0) + count
+        if type(self) is OneOrMore:
+            counts = dict((e, count * 2) for e, count in counts.items())
+        return counts
 
 
 class LeafPattern(Pattern):
@@ -274,6 +281,9 @@ class Either(BranchPattern):
             matched, _, _ = outcome = pattern.match(left, collected)
             if matched:
                 outcomes.append(outcome)
+            # nothing can beat a branch that consumed every argument
+            if matched and outcome[1] == []:
+                return outcome
         if outcomes:
             return min(outcomes, key=lambda outcome: len(outcome[1]))
         return False, left, collected
@@ -482,6 +492,124 @@ def extras(help, version, options, doc):
         sys.exit()
 
 
+def compile_doc(doc):
+    """Parse `doc` into its usage section, options and fixed pattern."""
+    usage_sections = parse_section('usage:', doc)
+    if len(usage_sections) == 0:
+        raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
+    if len(usage_sections) > 1:
+        raise DocoptLanguageError('More than one "usage:" (case-insensitive).')
+    usage = usage_sections[0]
+
+    options = parse_defaults(doc)
+    pattern = parse_pattern(formal_usage(usage), options)
+    # [default] syntax for argument is disabled
+    #for a in pattern.flat(Argument):
+    #    same_name = [d for d in arguments if d.name == a.name]
+    #    if same_name:
+    #        a.value = same_name[0].value
+    pattern_options = set(pattern.flat(Option))
+    for options_shortcut in pattern.flat(OptionsShortcut):
+        doc_options = parse_defaults(doc)
+        options_shortcut.children = list(set(doc_options) - pattern_options)
+        #if any_options:
+        #    options_shortcut.children += [Option(o.short, o.long, o.argcount)
+        #                    for o in argv if type(o) is Option]
+    return usage, options, pattern.fix()
+
+
+def dump_compiled(usage, options, pattern):
+    """Flatten a compiled doc into marshal data.
+
+    Tips are written once in a table and referenced by index, so tips
+    shared by fix_identities stay shared when loaded back.
+
+    """
+    tips, index = [], {}
+
+    def tip(o):
+        if id(o) not in index:
+            index[id(o)] = len(tips)
+            if type(o) is Option:
+                tips.append(('Option', (o.short, o.long, o.argcount, o.value)))
+            else:
+                tips.append((type(o).__name__, (o.name, o.value)))
+        return index[id(o)]
+
+    def tree(p):
+        if hasattr(p, 'children'):
+            return (type(p).__name__, [tree(c) for c in p.children])
+        return tip(p)
+
+    pattern = tree(pattern)
+    return marshal.dumps((usage, tips, [tip(o) for o in options], pattern))
+
+
+def load_compiled(data):
+    """Inverse of dump_compiled."""
+    types = dict((t.__name__, t) for t in (Argument, Command, Option, Required,
+                 Optional, OptionsShortcut, OneOrMore, Either))
+    usage, tips, options, pattern = marshal.loads(data)
+    tips = [types[name](*fields) for name, fields in tips]
+
+    def tree(p):
+        if type(p) is int:
+            return tips[p]
+        return types[p[0]](*[tree(c) for c in p[1]])
+
+    return usage, [tips[i] for i in options], tree(pattern)
+
+
+def get_cache_path(key):
+    """File for a compiled doc, or None if the disk cache is disabled.
+
+    DOCOPT_CACHE_DIR picks the directory, empty turns the cache off.
+
+    """
+    directory = os.environ.get('DOCOPT_CACHE_DIR')
+    if directory is None:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        directory = os.path.join(base, 'docopt')
+    if not directory:
+        return None
+    return os.path.join(directory, key + '.marshal')
+
+
+def get_compiled(doc):
+    """compile_doc(doc), cached in memory and on disk by a hash of doc."""
+    import hashlib
+    key = hashlib.sha1(('%s %s %s\n' % (__version__, CACHE_VERSION, marshal.version)
+                        + doc).encode('utf-8')).hexdigest()
+    if key in _compiled:
+        return load_compiled(_compiled[key])
+
+    path = get_cache_path(key)
+    if path is not None:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            compiled = load_compiled(data)
+            _compiled[key] = data
+            return compiled
+        except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+            pass  # missing or unreadable, compile it again
+
+    compiled = compile_doc(doc)
+    data = _compiled[key] = dump_compiled(*compiled)
+    if path is not None:
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            temp = '%s.%d.tmp' % (path, os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError:
+            pass
+    return compiled
+
+
 class Dict(dict):
     def __repr__(self):
         return '{%s}' % ',\n '.join('%r: %r' % i for i in sorted(self.items()))
@@ -552,30 +680,11 @@ def docopt(doc, argv=None, help=True, version=None, options_first=False):
     """
     argv = sys.argv[1:] if argv is None else argv
 
-    usage_sections = parse_section('usage:', doc)
-    if len(usage_sections) == 0:
-        raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
-    if len(usage_sections) > 1:
-        raise DocoptLanguageError('More than one "usage:" (case-insensitive).')
-    DocoptExit.usage = usage_sections[0]
-
-    options = parse_defaults(doc)
-    pattern = parse_pattern(formal_usage(DocoptExit.usage), options)
-    # [default] syntax for argument is disabled
-    #for a in pattern.flat(Argument):
-    #    same_name = [d for d in arguments if d.name == a.name]
-    #    if same_name:
-    #        a.value = same_name[0].value
+    usage, options, pattern = get_compiled(doc)
+    DocoptExit.usage = usage
     argv = parse_argv(Tokens(argv), list(options), options_first)
-    pattern_options = set(pattern.flat(Option))
-    for options_shortcut in pattern.flat(OptionsShortcut):
-        doc_options = parse_defaults(doc)
-        options_shortcut.children = list(set(doc_options) - pattern_options)
-        #if any_options:
-        #    options_shortcut.children += [Option(o.short, o.long, o.argcount)
-        #                    for o in argv if type(o) is Option]
     extras(help, version, argv, doc)
-    matched, left, collected = pattern.fix().match(argv)
+    matched, left, collected = pattern.match(argv)
     if matched and left == []:  # better error message if left?
         return Dict((a.name, a.value) for a in (pattern.flat() + collected))
     raise DocoptExit()
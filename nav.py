@@ -21,11 +21,15 @@
 """Nav.
 
 Usage:
-  nav create <src> [<dst>] [-m] [-q=QUALITY] [-o=FORMAT] [-i=FORMAT] [-r=SIZE] [-t=TITLE]
+  nav create <src> [<dst>] [-m] [-f] [-q=QUALITY] [-o=FORMAT] [-i=FORMAT] [-r=SIZE] [-t=TITLE] [-j=JOBS] [-b=BACKEND] [--batch] [--index-page-size=N] [--cache-dir=DIR] [--cache-size=MB] [--profile] [--srcset=WIDTHS] [-R] [--archive=FILE [--archive-only]]
+  nav watch <src> [<dst>] [-m] [-f] [-q=QUALITY] [-o=FORMAT] [-i=FORMAT] [-r=SIZE] [-t=TITLE] [-j=JOBS] [-b=BACKEND] [--batch] [--index-page-size=N] [--cache-dir=DIR] [--cache-size=MB] [--profile] [--srcset=WIDTHS]
+  nav serve <src> [<dst>] [-m] [-f] [-q=QUALITY] [-o=FORMAT] [-i=FORMAT] [-r=SIZE] [-t=TITLE] [-j=JOBS] [-b=BACKEND] [--index-page-size=N] [--cache-dir=DIR] [--cache-size=MB] [--srcset=WIDTHS] [-p=PORT]
   nav set [-q=QUALITY]
 
 Commands:
   create                    Main command to create navigation
+  watch                     Create navigation and update it when files change
+  serve                     Serve the navigation, making each file when it is first viewed
   set                       Set default settings
 
 Arguments:
@@ -33,7 +37,12 @@ Arguments:
   <dst>                     Destination directory to write output files
   QUALITY                   Integer between (1-100)
   FILE                      Valid file name
-  FORMAT                    Image format (jpg|png)
+  FORMAT                    Image format (jpg|png|webp|avif), or auto to pick one per output file
+  JOBS                      Number of parallel workers (0 = one per CPU)
+  BACKEND                   Image backend (imagemagick|pillow)
+  WIDTHS                    Comma separated widths (640,1280) or densities (1x,2x)
+  PORT                      Port of the local server
+  FILE                      Archive file name (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz)
 
 Options:
   -h --help                 Show this help message and exit
@@ -44,9 +53,31 @@ Options:
   -r --resize=SIZE          [default: 100%]
   -m --mobile               Create htmls with image-width at 100%
   -t --title=TITLE             Title of htmls [default: Navigation]
+  -j --jobs=JOBS            Convert files in parallel [default: 1]
+  -f --force                Rebuild every file, even if it has not changed
+  -b --backend=BACKEND      Image backend [default: imagemagick]
+  --batch                   Convert up to 32 files per ImageMagick process
+  --index-page-size=N       Thumbnails per index page, 0 for one page [default: 0]
+  -R --recursive            Build every subdirectory with input files
+  --cache-dir=DIR           Reuse converted images from a shared cache directory
+  --cache-size=MB           Size limit of the cache, least recently used go first [default: 1024]
+  --profile                 Time every build stage and write navzen-profile.json
+  --archive=FILE            Also pack the navigation into a zip or tar file
+  --archive-only            Write only the archive, not the output directory
+  --srcset=WIDTHS           Also write smaller copies of desktop images for srcset
+  -p --port=PORT            Port for nav serve [default: 8000]
 
 Examples:
   nav create d:/Dropbox/Secuoyas/web/visual/ -wm
+  nav create d:/Dropbox/Secuoyas/web/visual/ --jobs 8
+  nav create d:/Dropbox/Secuoyas/web/visual/ --backend pillow
+  nav create d:/Dropbox/Secuoyas/web/ --recursive --jobs 0
+  nav create d:/Dropbox/Secuoyas/web/visual/ --cache-dir ~/.cache/navzen
+  nav create d:/Dropbox/Secuoyas/web/visual/ --srcset 720,1440
+  nav create d:/Dropbox/Secuoyas/web/visual/ -o auto
+  nav create d:/Dropbox/Secuoyas/web/visual/ --archive visual.zip --archive-only
+  nav watch d:/Dropbox/Secuoyas/web/visual/ -m
+  nav serve d:/Dropbox/Secuoyas/web/visual/ --port 8080
   nav set --quality 20
   nav set --outputformat jpg
 
@@ -54,20 +85,17 @@ Examples:
 
 from __future__ import print_function
 from __future__ import division
-from docopt import docopt
 import os
 import sys
 import time
-import subprocess
+import threading
 import math
-import zipfile
+import itertools
 import re
-import imghdr
+import io
 import struct
-import platform
+import hashlib
 import json
-import shutil
-import filecmp
 
 
 # Defines
@@ -79,9 +107,370 @@ DESKTOP_HTML_SHEET = os.path.join(CONFIG_DIR_PATH, "nav-desktop.html")
 MOBILE_HTML_SHEET = os.path.join(CONFIG_DIR_PATH, "nav-mobile.html")
 INDEX_HTML_SHEET = os.path.join(CONFIG_DIR_PATH, "nav-index.html")
 INDEX_PAGE_NAME = "index.html"
-OS = platform.system()
+IMG_TAG = r"<[^>]+\[navzen-img\][^>]+>"
+SLICE_SLOTS = ['navzen-slice-width', 'navzen-slice-height', 'navzen-slice-loading']
+EAGER_SLICES = 1
+SLICE_STORE = "slices"
+MANIFEST_FILE_NAME = ".navzen-manifest.json"
+MANIFEST_VERSION = 1
+PROBE_CACHE_FILE_NAME = ".navzen-probe.json"
+PROBE_CACHE_VERSION = 1
+PROFILE_FILE_NAME = "navzen-profile.json"
+BATCH_SIZE = 32
+BAND_ROWS = 256
+PREVIEW_ASPECT_TOLERANCE = 0.01
+AUTO_SAMPLE_SIZE = 256
+AUTO_FLAT_COLORS = 256
+AUTO_FLAT_ENTROPY = 5.0
+AUTO_TIME_BUDGET = 2.0
+WATCH_DEBOUNCE = 0.5
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8000
+OS = None
+FICLONE = 0x40049409
 
 class Convert(object):
+    """Runs conversions through one of the image backends.
+
+    Every backend implements `do` (one output) and `render` (every output
+    of a render plan from a single decode) with the same options:
+    resize and crop in ImageMagick geometry syntax and quality.
+
+    With a RenderCache, outputs already rendered from the same source
+    content with the same options are linked from the cache instead of
+    being converted again.
+
+    With an ImageProbe, small outputs such as thumbnails are made from
+    the JPEG preview embedded in PSD and JPEG sources when it is big
+    enough, without decoding the whole source.
+    """
+
+    def __init__(self, backend='imagemagick', cache=None, probe=None):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend {0}, use one of: {1}".format(backend, ", ".join(sorted(BACKENDS))))
+        self.backendName = backend
+        self.backend = BACKENDS[backend]()
+        self.cache = cache
+        self.probe = probe
+
+    def do(self, inputFile, outputFile, options):
+        return self.render(inputFile, [(outputFile, options)])
+
+    def render(self, inputFile, plan):
+        """Produces every output of a render plan from a single decode.
+
+        `plan` is a list of (outputFile, options) pairs using the same
+        options as `do`. A source the backend fails on, e.g. a file that
+        is still being saved, does not stop the build: its outputs are
+        removed so the next build makes them again. Returns False if any
+        output could not be produced.
+        """
+        if self.cache is not None:
+            keys, plan = self.fetchCached(inputFile, plan)
+        if len(plan) == 0:
+            return True
+        staged = self.getStagedPlan(plan)
+        pending = self.renderEmbedded(inputFile, staged)
+        if len(pending) > 0:
+            try:
+                self.backend.render(inputFile, pending)
+            except Exception:
+                self.removeStaged(staged)
+        rendered = all(os.path.isfile(stagedFile) for stagedFile, options in staged)
+        self.commitOutputs(plan, staged)
+        if self.cache is not None:
+            self.storeCached(keys, plan)
+        return rendered
+
+    def renderBatch(self, items):
+        """Renders a list of (inputFile, plan) pairs.
+
+        Backends that can convert several sources in one go do so;
+        otherwise each source is rendered on its own. Returns the set of
+        input files whose outputs could not be produced.
+        """
+        if self.cache is not None:
+            cached = [(inputFile,) + self.fetchCached(inputFile, plan) for inputFile, plan in items]
+            items = [(inputFile, plan) for inputFile, keys, plan in cached if plan]
+        staged = [(inputFile, plan, self.getStagedPlan(plan)) for inputFile, plan in items]
+        items = [(inputFile, self.renderEmbedded(inputFile, stagedPlan)) for inputFile, plan, stagedPlan in staged]
+        items = [(inputFile, plan) for inputFile, plan in items if plan]
+
+        if hasattr(self.backend, 'renderBatch'):
+            failed = self.backend.renderBatch(items)
+        else:
+            failed = set()
+            for inputFile, plan in items:
+                try:
+                    self.backend.render(inputFile, plan)
+                except Exception:
+                    self.removeStaged(plan)
+                    failed.add(inputFile)
+        for inputFile, plan, stagedPlan in staged:
+            self.commitOutputs(plan, stagedPlan)
+
+        if self.cache is not None:
+            for inputFile, keys, plan in cached:
+                self.storeCached(keys, plan)
+        return failed
+
+    def renderEmbedded(self, inputFile, plan):
+        """Renders the outputs of plan that the embedded preview of the
+        source is big enough for and returns the rest of the plan. Only
+        PSD and JPEG sources have a preview.
+
+        The preview is resized to the exact size the output would have
+        from the full source, so crops keep their coordinates. Previews
+        whose aspect ratio differs from the source's by more than
+        PREVIEW_ASPECT_TOLERANCE are not used. Outputs
+        the preview could not produce are left in the returned plan.
+        Backends that spawn a process per render only use the preview
+        when it saves decoding the source altogether.
+        """
+        if self.probe is None or not hasattr(self.backend, 'renderData'):
+            return plan
+        size = self.probe.getSize(inputFile)
+        if size is None:
+            return plan
+
+        small = []
+        for outputFile, options in plan:
+            width, height = getResizedSize(size[0], size[1], options['resize'])
+            # Only outputs smaller than the source, never the image itself
+            if width < size[0]:
+                small.append((outputFile, dict(options, resize='{0}x{1}!'.format(width, height))))
+        if len(small) == 0:
+            return plan
+        thumbnail = self.probe.getThumbnail(inputFile)
+        if thumbnail is None:
+            return plan
+
+        data, thumbWidth, thumbHeight = thumbnail
+        # EXIF thumbnails are often a fixed 160x120 with black bars, they
+        # would come out stretched and letterboxed
+        aspect = (thumbWidth / float(thumbHeight)) / (size[0] / float(size[1]))
+        if abs(aspect - 1) > PREVIEW_ASPECT_TOLERANCE:
+            return plan
+        small = [(outputFile, options) for outputFile, options in small if parseGeometry(options['resize'])[0] <= thumbWidth]
+        if len(small) == 0:
+            return plan
+        if len(small) < len(plan) and getattr(self.backend, 'inProcess', False) == False:
+            return plan
+        try:
+            self.backend.renderData(data, small)
+        except Exception:
+            pass
+        return [(outputFile, options) for outputFile, options in plan if os.path.isfile(outputFile) == False]
+
+    def fetchCached(self, inputFile, plan):
+        """Links the cached outputs of plan and returns the cache keys and
+        the part of the plan that still has to be rendered."""
+        sourceHash = getFileHash(inputFile)
+        keys = {}
+        missing = []
+        for outputFile, options in plan:
+            keys[outputFile] = self.cache.getKey(sourceHash, self.backendName, outputFile, options)
+            if not self.cache.fetch(keys[outputFile], outputFile):
+                missing.append((outputFile, options))
+        return keys, missing
+
+    def getStagedPlan(self, plan):
+        """The plan writing to temporary names next to the outputs."""
+        return [(getTempPath(outputFile), options) for outputFile, options in plan]
+
+    def removeStaged(self, staged):
+        """Drops what a failed render left at the staged names."""
+        for stagedFile, options in staged:
+            if os.path.isfile(stagedFile):
+                os.remove(stagedFile)
+
+    def commitOutputs(self, plan, staged):
+        """Moves the staged outputs over the real ones.
+
+        An old output may be a hardlink into a render cache, so it is
+        replaced instead of being overwritten in place, and outputs that
+        come out byte for byte the same are left alone. Outputs that
+        could not be rendered are removed, so they are made again on the
+        next build.
+        """
+        for (outputFile, options), (stagedFile, stagedOptions) in zip(plan, staged):
+            if os.path.isfile(stagedFile):
+                commitFile(stagedFile, outputFile)
+            elif os.path.isfile(outputFile):
+                os.remove(outputFile)
+
+    def storeCached(self, keys, plan):
+        for outputFile, options in plan:
+            if os.path.isfile(outputFile):
+                self.cache.store(keys[outputFile], outputFile)
+
+
+class RenderCache(object):
+    """Content-addressed store of rendered outputs shared between builds.
+
+    Entries are keyed by the sha1 of the source content plus everything
+    passed to the backend (backend, output format, resize, crop,
+    quality) and are linked into output directories with `linkFile`.
+    The mtime of an entry is its last
+    use; `trim` removes the least recently used entries until the cache
+    fits in `limit` bytes.
+    """
+
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+        if os.path.isdir(directory) == False:
+            os.makedirs(directory)
+
+    def getKey(self, sourceHash, backend, outputFile, options):
+        params = [sourceHash, backend, os.path.splitext(outputFile)[1].lower(), options['resize'], options['crop'], str(options['quality'])]
+        if options.get('lossless'):
+            params.append('lossless')
+        return hashlib.sha1(json.dumps(params).encode("utf-8")).hexdigest()
+
+    def getPath(self, key, outputFile):
+        return os.path.join(self.directory, key[:2], key + os.path.splitext(outputFile)[1].lower())
+
+    def fetch(self, key, outputFile):
+        path = self.getPath(key, outputFile)
+        # A missing entry, even one evicted by another build after the
+        # utime, is a miss
+        try:
+            os.utime(path, None)
+            linkFile(path, outputFile)
+        except OSError:
+            return False
+        return True
+
+    def store(self, key, outputFile):
+        path = self.getPath(key, outputFile)
+        if os.path.isfile(path):
+            return
+        if os.path.isdir(os.path.dirname(path)) == False:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        linkFile(outputFile, path)
+
+    def trim(self):
+        entries = []
+        total = 0
+        for directory in os.scandir(self.directory):
+            if directory.is_dir():
+                for entry in os.scandir(directory.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # evicted by another build
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def getFileHash(path):
+    """sha1 of the file contents, memoized by (path, size, mtime)."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in FILE_HASHES:
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        FILE_HASHES[key] = sha.hexdigest()
+    return FILE_HASHES[key]
+
+
+FILE_HASHES = {}
+
+
+def getTempPath(path):
+    """Hidden name next to path, with the same extension so converters
+    pick the same format, for writes that replace path atomically."""
+    directory, name = os.path.split(path)
+    base, extension = os.path.splitext(name)
+    return os.path.join(directory, ".{0}.{1}.tmp{2}".format(base, threading.current_thread().ident, extension))
+
+
+def getOS():
+    """platform.system(), looked up the first time it is needed."""
+    global OS
+    if OS is None:
+        import platform
+        OS = platform.system()
+    return OS
+
+
+def isSameContent(path, other):
+    """True if other exists with the same bytes as path."""
+    import filecmp
+    try:
+        return os.path.samefile(path, other) or filecmp.cmp(path, other, shallow=False)
+    except OSError:
+        return False
+
+
+def commitFile(temp, path):
+    """Moves temp over path, unless path already has the same bytes: then
+    temp is dropped and path keeps its mtime. Returns True if path changed."""
+    if isSameContent(temp, path):
+        os.remove(temp)
+        return False
+    os.replace(temp, path)
+    return True
+
+
+def reflinkFile(source, destination):
+    """Copy-on-write clone of source (FICLONE, Linux only)."""
+    if getOS() != "Linux":
+        raise OSError("reflinks are not supported on {0}".format(getOS()))
+    import fcntl
+    with open(source, "rb") as src:
+        with open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def linkFile(source, destination):
+    """Makes destination a copy of source that costs no data writes where
+    possible: a reflink, else a hardlink, else a plain copy. The file is
+    made under a temporary name and replaces destination atomically, and
+    nothing is done if destination already has the same bytes. Returns
+    True if destination changed."""
+    import shutil
+    if isSameContent(source, destination):
+        return False
+    temp = getTempPath(destination)
+    for method in (reflinkFile, os.link, shutil.copyfile):
+        try:
+            method(source, temp)
+            break
+        except OSError:
+            if os.path.isfile(temp):
+                os.remove(temp)
+            if method is shutil.copyfile:
+                raise
+    os.replace(temp, destination)
+    return True
+
+
+class ImageMagickBackend(object):
+    """Runs the ImageMagick `convert` binary, one process per source."""
+
+    # PNG files carry their creation time by default, which would make
+    # every render differ from the last one
+    SETTINGS = ['-define', 'png:exclude-chunks=date,time']
+
+    # Formats `convert -list format` says it can write, looked up once
+    formats = None
 
     def __init__(self):
         self.app = self.getConvertBin()
@@ -90,16 +479,1442 @@ class Convert(object):
         return 'convert'
         # return "C:/Program Files/Adobe Photoshop CC 2014/convert.exe"
 
+    def getFormats(self):
+        """Output formats this convert can write. Builds without a WebP or
+        AVIF delegate are common, so those are only offered when listed."""
+        if ImageMagickBackend.formats is None:
+            import subprocess
+            formats = set(['png', 'jpg'])
+            try:
+                listing = subprocess.run([self.app, '-list', 'format'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+            except OSError:
+                listing = ""
+            for name, mode in re.findall(r"^\s*([A-Za-z0-9]+)\*?\s+\S+\s+([r-][w-])", listing, re.M):
+                if mode[1] == 'w':
+                    formats.add(name.lower())
+            ImageMagickBackend.formats = formats
+        return ImageMagickBackend.formats
+
     def do(self, inputFile, outputFile, options):
+            import subprocess
             psdfix = ''
             if os.path.splitext(inputFile)[1] == ".psd":
                 psdfix = "[0]"
-            subprocess.call([self.app, '-resize', options['resize'], '-crop', options['crop'], '-quality', options['quality'], inputFile+psdfix, outputFile], shell=False)
+            subprocess.call([self.app] + self.SETTINGS + self.getEncoderArgs(outputFile, options) + ['-resize', options['resize'], '-crop', options['crop'], '-quality', options['quality'], inputFile+psdfix, outputFile], shell=False)
+
+    def render(self, inputFile, plan):
+        """The source is read once and each output is made from an
+        in-memory clone, so decode work grows with the number of sources
+        and not with the number of outputs."""
+        import subprocess
+        if len(plan) == 1:
+            return self.do(inputFile, plan[0][0], plan[0][1])
+        subprocess.call([self.app] + self.SETTINGS + self.getRenderArgs(inputFile, plan) + ['null:'], shell=False)
+
+    def renderBatch(self, items):
+        """Converts many sources with a single `convert` process.
+
+        Each source is read inside its own parentheses, its outputs are
+        written from clones and the source is dropped before the next one
+        is read, so memory stays at one source at a time. ImageMagick
+        keeps going after a bad source, so the outputs are checked
+        afterwards and the sources with missing outputs are retried one
+        by one to find out which ones really fail.
+        """
+        import subprocess
+        for inputFile, plan in items:
+            for outputFile, options in plan:
+                if os.path.isfile(outputFile):
+                    os.remove(outputFile)
+
+        args = [self.app] + self.SETTINGS
+        for i, (inputFile, plan) in enumerate(items):
+            args += ['('] + self.getRenderArgs(inputFile, plan)
+            # The last source stays in the list so null: has something to write
+            if i < len(items) - 1:
+                args += ['+delete']
+            args += [')']
+        subprocess.call(args + ['null:'], shell=False)
+
+        failed = set()
+        for inputFile, plan in items:
+            if self.isMissingOutputs(plan):
+                self.render(inputFile, plan)
+                if self.isMissingOutputs(plan):
+                    failed.add(inputFile)
+        return failed
+
+    def renderData(self, data, plan):
+        """Renders a plan from JPEG data read from stdin."""
+        import subprocess
+        subprocess.run([self.app] + self.SETTINGS + self.getRenderArgs('jpeg:-', plan) + ['null:'], input=data, shell=False)
+
+    def isMissingOutputs(self, plan):
+        return any(os.path.isfile(outputFile) == False for outputFile, options in plan)
+
+    def getRenderArgs(self, inputFile, plan):
+        psdfix = ''
+        if os.path.splitext(inputFile)[1] == ".psd":
+            psdfix = "[0]"
+        args = [inputFile+psdfix]
+        for outputFile, options in plan:
+            args += ['(', '+clone',
+                '-resize', options['resize'],
+                '-crop', options['crop'],
+                '-quality', options['quality']
+            ] + self.getEncoderArgs(outputFile, options) + [
+                '-write', outputFile,
+                '+delete', ')']
+        return args
+
+    def getEncoderArgs(self, outputFile, options):
+        # Defines are not scoped by parentheses, so every WebP output sets its own
+        if os.path.splitext(outputFile)[1].lower() == ".webp":
+            return ['-define', 'webp:lossless={0}'.format("true" if options.get('lossless') else "false")]
+        return []
+
+
+class PillowBackend(object):
+    """Decodes, resizes, crops and encodes in-process with Pillow.
+
+    No process is spawned, which is most of the cost for small PNG/JPEG
+    sources and thumbnails. Geometries follow ImageMagick: "50%", "120x",
+    "x90", "800x600" (fit), "800x600!" (exact) with optional ">" or "<"
+    for resize, and "WxH+X+Y" or a percentage tile for crop.
+
+    With NumPy installed, PSD and PSB sources are read with PsdReader and
+    every output is made BAND_ROWS rows at a time, so memory is bounded
+    by the width of the source and not by the whole canvas. PNG outputs
+    are also encoded band by band; other formats hold one output.
+    """
+
+    inProcess = True
+
+    def getFormats(self):
+        return getPillowFormats()
+
+    def __init__(self):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ValueError("The pillow backend needs Pillow (pip install Pillow)")
+        self.Image = Image
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.numpy = numpy
+
+    def do(self, inputFile, outputFile, options):
+        return self.render(inputFile, [(outputFile, options)])
+
+    def render(self, inputFile, plan):
+        if self.numpy is not None and os.path.splitext(inputFile)[1].lower() in (".psd", ".psb"):
+            try:
+                reader = PsdReader(inputFile)
+            except ValueError:
+                # Color modes and compressions it can't read go to Pillow
+                reader = None
+            if reader is not None:
+                try:
+                    return self.renderBanded(reader, plan)
+                finally:
+                    reader.close()
+        self.renderImage(self.Image.open(inputFile), plan)
+
+    def renderData(self, data, plan):
+        self.renderImage(self.Image.open(io.BytesIO(data)), plan)
+
+    def renderImage(self, source, plan):
+        source.load()
+        for outputFile, options in plan:
+            image = source
+            size = getResizedSize(image.size[0], image.size[1], options['resize'])
+            if size != image.size:
+                image = image.resize(size, self.Image.LANCZOS)
+            box = getCropBox(image.size[0], image.size[1], options['crop'])
+            if box != (0, 0) + image.size:
+                image = image.crop(box)
+            self.save(image, outputFile, int(options['quality']), options.get('lossless', False))
+
+    def renderBanded(self, reader, plan):
+        """Makes each output of plan from bands of source rows.
+
+        A band of output rows is resized from the source rows it covers,
+        plus a margin for the resampling filter, using the exact source
+        region as resize box, so bands line up as in a whole image resize.
+        """
+        width, height = reader.width, reader.height
+        for outputFile, options in plan:
+            size = getResizedSize(width, height, options['resize'])
+            left, top, right, bottom = getCropBox(size[0], size[1], options['crop'])
+            scaleX = size[0] / width
+            scaleY = size[1] / height
+            margin = int(math.ceil(3 / min(scaleY, 1))) + 1
+
+            quality = int(options['quality'])
+            png = os.path.splitext(outputFile)[1].lower() == ".png"
+            if png:
+                output = PngWriter(outputFile, right - left, bottom - top, reader.mode, min(9, quality // 10))
+            else:
+                output = self.Image.new(reader.mode, (right - left, bottom - top))
+
+            for y in range(top, bottom, BAND_ROWS):
+                end = min(bottom, y + BAND_ROWS)
+                sourceTop = y / scaleY
+                sourceBottom = end / scaleY
+                bandTop = max(0, int(sourceTop) - margin)
+                bandBottom = min(height, int(math.ceil(sourceBottom)) + margin)
+                band = reader.readBand(bandTop, bandBottom)
+                if size == (width, height):
+                    band = band.crop((left, y - bandTop, right, end - bandTop))
+                else:
+                    box = (left / scaleX, sourceTop - bandTop, right / scaleX, sourceBottom - bandTop)
+                    band = band.resize((right - left, end - y), self.Image.LANCZOS, box=box)
+                if png:
+                    output.write(self.numpy.asarray(band))
+                else:
+                    output.paste(band, (0, y - top))
+
+            if png:
+                output.close()
+            else:
+                self.save(output, outputFile, quality, options.get('lossless', False))
+
+    def save(self, image, outputFile, quality, lossless=False):
+        fileFormat, params = getSaveOptions(os.path.splitext(outputFile)[1], quality, lossless)
+        if fileFormat == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+        image.save(outputFile, fileFormat, **params)
+
+
+def getSaveOptions(extension, quality, lossless=False):
+    """Pillow format name and save parameters for an output extension."""
+    extension = extension.lower().lstrip(".")
+    if extension in ("jpg", "jpeg"):
+        return "JPEG", {'quality': quality}
+    if extension == "png":
+        # As in ImageMagick the tens digit of the quality is the zlib level
+        return "PNG", {'compress_level': min(9, quality // 10)}
+    if extension == "webp":
+        return "WEBP", {'quality': quality, 'lossless': lossless}
+    if extension == "avif":
+        return "AVIF", {'quality': quality}
+    return None, {'quality': quality}
+
+
+class PsdReader(object):
+    """Composite image of a PSD or PSB file, read a band of rows at a time.
+
+    The file is memory mapped and only the rows of a band are decoded.
+    For RLE data the offset of every row comes from the byte counts
+    table, so any band can be read without decoding the rows above it.
+    Reads 8 and 16 bit grayscale and RGB with raw or RLE compression;
+    the merged transparency is used when the file has one. Needs NumPy
+    and Pillow. Anything else raises ValueError.
+    """
+
+    def __init__(self, path):
+        import mmap
+        import numpy
+        from PIL import Image
+        self.numpy = numpy
+        self.Image = Image
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.parse()
+        except (ValueError, struct.error, OSError):
+            self.close()
+            raise ValueError("Unsupported PSD file {0}".format(path))
+
+    def parse(self):
+        data = self.data
+        signature, version, channels, height, width, depth, mode = struct.unpack_from(">4sH6xHLLHH", data, 0)
+        if signature != b"8BPS" or version not in (1, 2) or depth not in (8, 16) or mode not in (1, 3):
+            raise ValueError("Unsupported PSD")
+        # PSB uses 8 bytes for the lengths of the layer sections and 4 for RLE byte counts
+        lengthFormat, countFormat = (">Q", ">u4") if version == 2 else (">L", ">u2")
+        self.width, self.height, self.depth = width, height, depth
+
+        pos = 26
+        # Color mode data and image resources
+        for i in range(2):
+            pos += 4 + struct.unpack_from(">L", data, pos)[0]
+        # Layer and mask info; a negative layer count means the first
+        # alpha channel is the transparency of the merged image
+        layersLength = struct.unpack_from(lengthFormat, data, pos)[0]
+        lengthSize = struct.calcsize(lengthFormat)
+        alpha = False
+        if layersLength >= lengthSize + 2:
+            alpha = struct.unpack_from(">h", data, pos + lengthSize * 2)[0] < 0
+        pos += lengthSize + layersLength
+
+        colors = 3 if mode == 3 else 1
+        self.channels = min(channels, colors + (1 if alpha else 0))
+        self.mode = {1: "L", 3: "RGB", 4: "RGBA"}.get(self.channels)
+        if self.mode is None or channels < colors:
+            raise ValueError("Unsupported PSD")
+        self.rowBytes = width * depth // 8
+
+        compression = struct.unpack_from(">H", data, pos)[0]
+        pos += 2
+        if compression == 0:
+            self.offsets = None
+            self.base = pos
+        elif compression == 1:
+            counts = self.numpy.frombuffer(data, dtype=countFormat, count=channels * height, offset=pos)
+            self.offsets = self.numpy.concatenate(([0], self.numpy.cumsum(counts, dtype=self.numpy.int64))) + pos + counts.nbytes
+        else:
+            raise ValueError("Unsupported PSD compression")
+
+    def readBand(self, top, bottom):
+        """Rows top to bottom as a Pillow image."""
+        numpy = self.numpy
+        rows = bottom - top
+        planes = []
+        for channel in range(self.channels):
+            first = channel * self.height + top
+            if self.offsets is None:
+                start = self.base + first * self.rowBytes
+                raw = self.data[start:start + rows * self.rowBytes]
+            else:
+                # Pillow's PackBits decoder does the RLE in C
+                raw = self.data[int(self.offsets[first]):int(self.offsets[first + rows])]
+                raw = self.Image.frombytes("L", (self.rowBytes, rows), raw, "packbits", "L").tobytes()
+            plane = numpy.frombuffer(raw, dtype=numpy.uint8 if self.depth == 8 else ">u2").reshape(rows, self.width)
+            if self.depth == 16:
+                plane = (plane >> 8).astype(numpy.uint8)
+            planes.append(plane)
+        if len(planes) == 1:
+            return self.Image.fromarray(planes[0], "L")
+        return self.Image.fromarray(numpy.dstack(planes), self.mode)
+
+    def close(self):
+        if getattr(self, 'data', None) is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+
+class PngWriter(object):
+    """Writes an 8 bit PNG a band of rows at a time.
+
+    Rows use the Up filter, which suits flat UI screens and can be done
+    for a whole band at once with NumPy.
+    """
+
+    COLOR_TYPES = {'L': 0, 'RGB': 2, 'RGBA': 6}
+
+    def __init__(self, path, width, height, mode, level):
+        import zlib
+        import numpy
+        self.zlib = zlib
+        self.numpy = numpy
+        self.f = open(path, "wb")
+        self.f.write(b"\x89PNG\r\n\x1a\n")
+        self.writeChunk(b"IHDR", struct.pack(">LLBBBBB", width, height, 8, self.COLOR_TYPES[mode], 0, 0, 0))
+        self.compressor = zlib.compressobj(level)
+        self.previous = None
+
+    def writeChunk(self, kind, data):
+        self.f.write(struct.pack(">L", len(data)) + kind + data)
+        self.f.write(struct.pack(">L", self.zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, band):
+        numpy = self.numpy
+        rows = band.reshape(band.shape[0], -1)
+        above = numpy.empty_like(rows)
+        above[0] = self.previous if self.previous is not None else 0
+        above[1:] = rows[:-1]
+        filtered = numpy.empty((rows.shape[0], rows.shape[1] + 1), dtype=numpy.uint8)
+        filtered[:, 0] = 2
+        filtered[:, 1:] = rows - above
+        self.previous = rows[-1].copy()
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.writeChunk(b"IDAT", data)
+
+    def close(self):
+        self.writeChunk(b"IDAT", self.compressor.flush())
+        self.writeChunk(b"IEND", b"")
+        self.f.close()
+
+
+BACKENDS = {
+    'imagemagick': ImageMagickBackend,
+    'pillow': PillowBackend
+}
+
+
+def getPillowFormats():
+    """Output formats Pillow can encode; png and jpg are always there."""
+    formats = set(['png', 'jpg'])
+    try:
+        from PIL import features
+    except ImportError:
+        return formats
+    for name in ('webp', 'avif'):
+        try:
+            if features.check(name):
+                formats.add(name)
+        except ValueError:
+            pass
+    return formats
+
+
+def parseSrcset(value):
+    """Parses --srcset: pixel widths ("640,1280") or densities ("1x,2x").
+
+    Returns ('w', widths) or ('x', densities), sorted.
+    """
+    items = [item.strip().lower() for item in value.split(",") if item.strip()]
+    try:
+        if items and all(item.endswith("x") for item in items):
+            return 'x', sorted(set(float(item[:-1]) for item in items))
+        if items:
+            return 'w', sorted(set(int(item) for item in items))
+    except ValueError:
+        pass
+    raise ValueError("Invalid srcset {0}, use widths (640,1280) or densities (1x,2x)".format(value))
+
+
+def getSrcsetCandidate(name, descriptor):
+    """One srcset candidate. A space ends the URL of a candidate, so the
+    file name is percent-encoded.
+
+    >>> getSrcsetCandidate("screen 1-200w.png", "200w")
+    'screen%201-200w.png 200w'
+    """
+    from urllib.parse import quote
+    return "{0} {1}".format(quote(name), descriptor)
+
+
+def parseGeometry(geometry):
+    """Splits an ImageMagick geometry into (width, height, x, y, flags).
+
+    Missing parts are None. Percent geometries keep the "%" in flags and
+    their numbers as floats.
+    """
+    match = re.match(r"^\s*(\d*\.?\d*)(?:x(\d*\.?\d*))?([-+]\d+)?([-+]\d+)?([%!<>^]*)\s*$", geometry)
+    if match is None:
+        raise ValueError("Invalid geometry {0}".format(geometry))
+    width, height, x, y, flags = match.groups()
+    number = float if "%" in flags else int
+    return (
+        number(width) if width else None,
+        number(height) if height else None,
+        int(x) if x else None,
+        int(y) if y else None,
+        flags
+    )
+
+
+def getResizedSize(width, height, geometry):
+    """Size of a width x height image after `-resize geometry`."""
+    gw, gh, x, y, flags = parseGeometry(geometry)
+
+    if "%" in flags:
+        sx = (gw if gw is not None else 100.0) / 100
+        sy = (gh if gh is not None else sx * 100) / 100
+        return max(1, int(width * sx + 0.5)), max(1, int(height * sy + 0.5))
+
+    if gw is None and gh is None:
+        return width, height
+    if "!" in flags and gw and gh:
+        newWidth, newHeight = gw, gh
+    else:
+        scale = min(gw / width if gw else float("inf"), gh / height if gh else float("inf"))
+        newWidth, newHeight = int(width * scale + 0.5), int(height * scale + 0.5)
+    if ">" in flags and (width <= newWidth and height <= newHeight):
+        return width, height
+    if "<" in flags and (width >= newWidth and height >= newHeight):
+        return width, height
+    return max(1, newWidth), max(1, newHeight)
+
+
+def getCropBox(width, height, geometry):
+    """(left, top, right, bottom) of `-crop geometry` on a width x height
+    image. Percentages crop the first tile of that size."""
+    gw, gh, x, y, flags = parseGeometry(geometry)
+
+    if "%" in flags:
+        gw = int(width * gw / 100 + 0.5) if gw is not None else width
+        gh = int(height * gh / 100 + 0.5) if gh is not None else gw * height // width
+    left = min(width, max(0, x or 0))
+    top = min(height, max(0, y or 0))
+    right = min(width, left + (gw or width))
+    bottom = min(height, top + (gh or height))
+    return left, top, right, bottom
+
+
+class ImageProbe(object):
+    """Reads the format and dimensions of images from their header.
+
+    Every file is read once with a single buffered read (JPEG files whose
+    frame header is further away read more, in blocks). Results are
+    memoized by (path, size, mtime) and can be saved to a cache file so
+    unchanged sources are not opened again on the next build.
+    """
+
+    HEADER_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.cache = {}
+        self.cacheFile = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self, cacheFile):
+        self.cacheFile = cacheFile
+        try:
+            with open(cacheFile, "r") as f:
+                cache = json.load(f)
+            if cache.get('version') == PROBE_CACHE_VERSION:
+                for path, record in cache['files'].items():
+                    self.cache[path] = tuple(record)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        if self.cacheFile is None or not self.dirty:
+            return
+        with self.lock:
+            cache = {'version': PROBE_CACHE_VERSION, 'files': self.cache}
+            with open(self.cacheFile + ".tmp", "w") as f:
+                json.dump(cache, f)
+            os.replace(self.cacheFile + ".tmp", self.cacheFile)
+            self.dirty = False
+
+    def getSize(self, path):
+        """Returns (width, height) of the image or None if it can't be read."""
+        info = self.getInfo(path)
+        if info is None:
+            return None
+        return info[1], info[2]
+
+    def getInfo(self, path):
+        """Returns (format, width, height) of the image or None."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        record = self.cache.get(path)
+        if record is not None and record[0] == stat.st_size and record[1] == stat.st_mtime:
+            return record[2]
+
+        with open(path, "rb") as f:
+            info = self.probe(f)
+
+        with self.lock:
+            self.cache[path] = (stat.st_size, stat.st_mtime, info)
+            self.dirty = True
+        return info
+
+    def probe(self, f):
+        head = f.read(self.HEADER_SIZE)
+
+        if head[:4] == b"8BPS":
+            # PSD (version 1) and PSB (version 2) share the header layout
+            if len(head) < 22:
+                return None
+            height, width = struct.unpack(">LL", head[14:22])
+            return ["psb" if head[4:6] == b"\x00\x02" else "psd", width, height]
+
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            if len(head) < 24 or head[12:16] != b"IHDR":
+                return None
+            width, height = struct.unpack(">LL", head[16:24])
+            return ["png", width, height]
+
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            if len(head) < 10:
+                return None
+            width, height = struct.unpack("<HH", head[6:10])
+            return ["gif", width, height]
+
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return self.probeWebp(head)
+
+        if head[:2] == b"\xff\xd8":
+            return self.probeJpeg(f, head)
+
+        return None
+
+    def getThumbnail(self, path):
+        """Returns the JPEG preview embedded in a PSD (image resource 1036)
+        or in the EXIF data of a JPEG as (data, width, height), or None."""
+        try:
+            with open(path, "rb") as f:
+                head = f.read(4)
+                if head == b"8BPS":
+                    data = self.readPsdThumbnail(f)
+                elif head[:2] == b"\xff\xd8":
+                    data = self.readExifThumbnail(f)
+                else:
+                    return None
+        except (IOError, OSError, struct.error):
+            return None
+        if not data:
+            return None
+        info = self.probe(io.BytesIO(data))
+        if info is None or info[0] != "jpeg":
+            return None
+        return data, info[1], info[2]
+
+    def readPsdThumbnail(self, f):
+        """Walks the image resources of a PSD looking for resource 1036."""
+        f.seek(26)
+        # Skip the color mode data
+        f.seek(struct.unpack(">L", f.read(4))[0], 1)
+        end = struct.unpack(">L", f.read(4))[0] + f.tell()
+        while f.tell() + 12 <= end:
+            # Resource block: signature, id, even padded pascal name, size
+            # and even padded data
+            signature, resource, nameLength = struct.unpack(">4sHB", f.read(7))
+            f.seek(nameLength + (nameLength + 1) % 2, 1)
+            size = struct.unpack(">L", f.read(4))[0]
+            if resource == 1036 and size > 28:
+                # 28 bytes of thumbnail header, format 1 is JFIF data
+                header = f.read(28)
+                if struct.unpack(">L", header[:4])[0] != 1:
+                    return None
+                return f.read(size - 28)
+            f.seek(size + size % 2, 1)
+        return None
+
+    def readExifThumbnail(self, f):
+        """Reads the JPEG thumbnail of IFD1 from the EXIF segment."""
+        pos = 2
+        while True:
+            f.seek(pos)
+            header = f.read(4)
+            if len(header) < 4 or header[:1] != b"\xff":
+                return None
+            marker = ord(header[1:2])
+            # Metadata comes before the frame and scan headers
+            if marker == 0xda or 0xc0 <= marker <= 0xcf:
+                return None
+            length = struct.unpack(">H", header[2:4])[0]
+            if marker == 0xe1:
+                segment = f.read(length - 2)
+                if segment[:6] == b"Exif\x00\x00":
+                    return self.getExifThumbnail(segment[6:])
+            pos += 2 + length
+
+    def getExifThumbnail(self, tiff):
+        order = "<" if tiff[:2] == b"II" else ">"
+        ifd = struct.unpack(order + "L", tiff[4:8])[0]
+        count = struct.unpack(order + "H", tiff[ifd:ifd+2])[0]
+        ifd = struct.unpack(order + "L", tiff[ifd+2+count*12:ifd+6+count*12])[0]
+        if ifd == 0:
+            return None
+        count = struct.unpack(order + "H", tiff[ifd:ifd+2])[0]
+        tags = {}
+        for i in range(count):
+            tag, kind, number, value = struct.unpack(order + "HHLL", tiff[ifd+2+i*12:ifd+14+i*12])
+            tags[tag] = value
+        # JPEGInterchangeFormat and JPEGInterchangeFormatLength
+        if 0x0201 not in tags or 0x0202 not in tags:
+            return None
+        return tiff[tags[0x0201]:tags[0x0201]+tags[0x0202]]
+
+    def probeWebp(self, head):
+        chunk = head[12:16]
+        if chunk == b"VP8 " and len(head) >= 30:
+            width, height = struct.unpack("<HH", head[26:30])
+            return ["webp", width & 0x3fff, height & 0x3fff]
+        if chunk == b"VP8L" and len(head) >= 25:
+            bits = struct.unpack("<L", head[21:25])[0]
+            return ["webp", (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1]
+        if chunk == b"VP8X" and len(head) >= 30:
+            width = struct.unpack("<L", head[24:27] + b"\x00")[0] + 1
+            height = struct.unpack("<L", head[27:30] + b"\x00")[0] + 1
+            return ["webp", width, height]
+        return None
+
+    def probeJpeg(self, f, data):
+        """Walks the JPEG segments up to the first SOFn frame header."""
+        base = 0
+        pos = 2
+        while True:
+            # Segment header: 0xff, marker, 2 bytes length, and the frame
+            # header needs 5 more. Big segments (EXIF, ICC...) are skipped
+            # with a seek instead of being read.
+            if pos + 9 > base + len(data):
+                f.seek(pos)
+                data = f.read(self.HEADER_SIZE)
+                base = pos
+                if len(data) < 9:
+                    return None
+            i = pos - base
+            if data[i:i+1] != b"\xff":
+                return None
+            marker = ord(data[i+1:i+2])
+            if marker == 0xff:
+                # Fill byte
+                pos += 1
+                continue
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack(">HH", data[i+5:i+9])
+                return ["jpeg", width, height]
+            pos += 2 + struct.unpack(">H", data[i+2:i+4])[0]
+
+
+class FormatSelector(object):
+    """Picks the output format of each source for --outputformat auto.
+
+    A small sample of the source (the embedded preview when it has one)
+    tells flat UI screens from photo-like ones: few colours or a low
+    entropy mean flat. Flat screens are tried with lossless formats and
+    the rest with lossy ones at the --quality. Each candidate encodes the
+    sample, its encode time is scaled up to the size of the source, and
+    the smallest one within AUTO_TIME_BUDGET seconds wins. Only formats
+    both Pillow and the backend (`formats`) can encode are tried. Needs
+    Pillow; without it, JPEG sources get jpg and everything else png.
+    """
+
+    # (format, lossless)
+    FLAT_CANDIDATES = [('png', False), ('webp', True)]
+    PHOTO_CANDIDATES = [('jpg', False), ('webp', False), ('avif', False)]
+
+    def __init__(self, quality, probe, budget=AUTO_TIME_BUDGET, formats=None):
+        self.quality = int(quality)
+        self.probe = probe
+        self.budget = budget
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = None
+        self.Image = Image
+        self.available = getPillowFormats() & formats if formats is not None else getPillowFormats()
+
+    def choose(self, path):
+        """Returns (format, lossless) for the outputs of path."""
+        sample = self.getSample(path)
+        if sample is None:
+            info = self.probe.getInfo(path)
+            return ('jpg' if info is not None and info[0] == "jpeg" else 'png'), False
+
+        flat = sample.getcolors(AUTO_FLAT_COLORS) is not None or sample.convert("L").entropy() < AUTO_FLAT_ENTROPY
+        candidates = [c for c in (self.FLAT_CANDIDATES if flat else self.PHOTO_CANDIDATES) if c[0] in self.available]
+        size = self.probe.getSize(path)
+        scale = size[0] * size[1] / (sample.size[0] * sample.size[1]) if size else 1
+
+        best = None
+        for fileFormat, lossless in candidates:
+            fileFormatName, params = getSaveOptions(fileFormat, self.quality, lossless)
+            data = io.BytesIO()
+            start = time.time()
+            try:
+                sample.save(data, fileFormatName, **params)
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            elapsed = (time.time() - start) * scale
+            # The first candidate is the fallback, whatever it costs
+            if best is not None and elapsed > self.budget:
+                continue
+            if best is None or data.tell() < best[0]:
+                best = (data.tell(), fileFormat, lossless)
+        if best is None:
+            return 'png', False
+        return best[1], best[2]
+
+    def getSample(self, path):
+        """The source (or its preview) down to AUTO_SAMPLE_SIZE pixels, or None."""
+        if self.Image is None:
+            return None
+        try:
+            thumbnail = self.probe.getThumbnail(path)
+            if thumbnail is not None:
+                image = self.Image.open(io.BytesIO(thumbnail[0]))
+            else:
+                image = self.Image.open(path)
+                # JPEG decodes at a fraction of the size
+                image.draft("RGB", (AUTO_SAMPLE_SIZE, AUTO_SAMPLE_SIZE))
+            image = image.convert("RGB")
+            image.thumbnail((AUTO_SAMPLE_SIZE, AUTO_SAMPLE_SIZE))
+            return image
+        except (IOError, OSError, ValueError, SyntaxError):
+            return None
+
+
+class Watcher(object):
+    """Waits for changes to the source files of a directory.
+
+    Uses inotify on Linux and falls back to polling the directory
+    elsewhere or when inotify is not available. Changes are debounced:
+    `wait` returns once no more changes arrive for `debounce` seconds,
+    so a burst of saves triggers a single rebuild.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self, directory, extension, debounce=WATCH_DEBOUNCE):
+        self.directory = directory
+        self.extension = extension
+        self.debounce = debounce
+        self.fd = None
+        if getOS() == "Linux":
+            try:
+                self.fd = self.initInotify()
+            except (OSError, AttributeError):
+                self.fd = None
+        self.snapshot = self.getSnapshot() if self.fd is None else None
+
+    def getMode(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def initInotify(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE | self.IN_MODIFY
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, "inotify_add_watch failed")
+        return fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def isSource(self, name):
+        return name[len(self.extension)*-1:] == self.extension and not name.startswith(".")
+
+    def wait(self):
+        """Blocks until source files changed. Returns their names."""
+        if self.fd is not None:
+            return self.waitInotify()
+        return self.waitPolling()
+
+    def waitInotify(self):
+        import select
+        changed = set()
+        while True:
+            timeout = self.debounce if changed else None
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return changed
+            data = os.read(self.fd, 64 * 1024)
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+                name = os.fsdecode(data[pos+16:pos+16+length].rstrip(b"\x00"))
+                pos += 16 + length
+                if self.isSource(name):
+                    changed.add(name)
+
+    def waitPolling(self):
+        changed = set()
+        while True:
+            time.sleep(self.debounce)
+            snapshot = self.getSnapshot()
+            names = set(snapshot) | set(self.snapshot)
+            diff = set(name for name in names if snapshot.get(name) != self.snapshot.get(name))
+            self.snapshot = snapshot
+            if diff:
+                changed |= diff
+            elif changed:
+                return changed
+
+    def getSnapshot(self):
+        snapshot = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and self.isSource(entry.name):
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+
+class Server(object):
+    """HTTP server for `nav serve`.
+
+    Nothing is rendered up front: the html, image, slices and thumb of a
+    screen are made the first time they are requested, so the time to
+    the first page does not grow with the number of files. What is made
+    is recorded in the manifest with the size and mtime of its source,
+    and made again once the source changes, so later runs and `nav
+    create` reuse it. Thumbs are also made by background workers, those
+    of the index page being viewed first.
+    """
+
+    INDEX_PAGE = re.compile(r"^{0}(?:-(\d+))?\.html$".format(re.escape(os.path.splitext(INDEX_PAGE_NAME)[0])))
+    VARIANT = re.compile(r"^(.*)(?:_slice_\d+|-\d+w)$")
+
+    def __init__(self, navzen, port, host=SERVE_HOST):
+        import heapq
+        from http.server import ThreadingHTTPServer
+        self.heapq = heapq
+        self.navzen = navzen
+        self.lock = threading.Lock()
+        self.manifestLock = threading.Lock()
+        self.sourceLocks = {}
+        self.queue = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.workers = []
+        self.httpd = ThreadingHTTPServer((host, port), self.getHandler())
+        self.httpd.daemon_threads = True
+        self.directoryMtime = None
+        self.sources = {}
+        navzen.server = self
+
+        # What the last build or run made is kept while its options and
+        # sources are the same
+        manifest = navzen.loadManifest()
+        self.files = {}
+        if navzen.a.get('force') != True and manifest.get('options') == navzen.getBuildOptions():
+            self.files = manifest.get('files', {})
+        self.htmlDone = set()
+        if manifest.get('template') == navzen.getTemplateHash():
+            self.htmlDone = set(self.files)
+
+        self.refresh()
+
+    def getURL(self):
+        return "http://{0}:{1}/".format(*self.httpd.server_address[:2])
+
+    def run(self):
+        for i in range(self.navzen.getJobs()):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.httpd.serve_forever()
+
+    def close(self):
+        """Stops the server and waits for the thumbs being made."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.httpd.server_close()
+
+    def getHandler(self):
+        from http.server import SimpleHTTPRequestHandler
+        from urllib.parse import unquote, urlsplit, quote
+        server = self
+
+        class Handler(SimpleHTTPRequestHandler):
+
+            def __init__(self, *args, **kwargs):
+                SimpleHTTPRequestHandler.__init__(self, *args, directory=server.navzen.a['outputDirectory'], **kwargs)
+
+            def do_GET(self):
+                if self.prepare():
+                    SimpleHTTPRequestHandler.do_GET(self)
+
+            def do_HEAD(self):
+                if self.prepare():
+                    SimpleHTTPRequestHandler.do_HEAD(self)
+
+            def prepare(self):
+                name = unquote(urlsplit(self.path).path).lstrip("/")
+                try:
+                    location = server.prepare(name)
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return False
+                if location is not None:
+                    self.send_response(302)
+                    self.send_header("Location", "/" + quote(location))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return False
+                return True
+
+            def log_message(self, format, *args):
+                pass
+
+            def log_request(self, code='-', size='-'):
+                if str(code).startswith(("4", "5")):
+                    print("\033[91m{0} {1}\033[0m".format(code, self.path), file=sys.stderr)
+
+        return Handler
+
+    def refresh(self):
+        """Rescans the sources and rewrites the index when the source
+        directory changed. Every source goes in the thumb queue."""
+        navzen = self.navzen
+        with self.lock:
+            mtime = os.stat(navzen.a['inputDirectory']).st_mtime_ns
+            if mtime == self.directoryMtime:
+                return
+            self.directoryMtime = mtime
+            navzen.fileIndexes = {}
+            allpsds = navzen.getFilesFromDirectory(navzen.a['inputDirectory'], navzen.a['inputformat'])
+            self.sources = dict((os.path.splitext(os.path.basename(psd))[0], psd) for psd in allpsds)
+        for psd in allpsds:
+            with self.getSourceLock(psd):
+                self.checkEntry(psd)
+        with self.lock:
+            navzen.createIndex()
+        for psd in allpsds:
+            self.push(psd, 2)
+
+    def prepare(self, name):
+        """Makes what name needs before it is served. Returns the name to
+        redirect to when the file has another name, e.g. the format of an
+        auto thumb was not known when the index was written."""
+        self.refresh()
+        if name == "":
+            name = INDEX_PAGE_NAME
+
+        match = self.INDEX_PAGE.match(name)
+        if match:
+            # Thumbs of the page being viewed go first
+            navzen = self.navzen
+            allpsds = navzen.getFilesFromDirectory(navzen.a['inputDirectory'], navzen.a['inputformat'])
+            pageSize = int(navzen.a.get('indexPageSize') or 0) or max(1, len(allpsds))
+            number = int(match.group(1) or 1)
+            for psd in reversed(allpsds[(number - 1) * pageSize:number * pageSize]):
+                self.push(psd, 0)
+            return None
+
+        psd, kind = self.getSource(name)
+        if psd is None:
+            return None
+        self.ensure(psd, kind)
+
+        if kind == 'thumb':
+            actual = os.path.basename(self.navzen.getThumbnailPlan(psd)[0][0])
+        elif kind == 'image' and os.path.splitext(name)[0] == os.path.splitext(os.path.basename(psd))[0]:
+            actual = os.path.basename(self.navzen.getImagePlan(psd)[0][0])
+        else:
+            return None
+        if actual != name and os.path.isfile(os.path.join(self.navzen.a['outputDirectory'], actual)):
+            return actual
+        return None
+
+    def getSource(self, name):
+        """(source, kind) of an output name, kind being html, image
+        (also slices and srcset copies) or thumb."""
+        if "/" in name:
+            return None, None
+        stem, extension = os.path.splitext(name)
+        if extension == ".html":
+            return self.sources.get(stem), 'html'
+        if stem.endswith("_thumb") and stem[:-len("_thumb")] in self.sources:
+            return self.sources[stem[:-len("_thumb")]], 'thumb'
+        if stem in self.sources:
+            return self.sources[stem], 'image'
+        match = self.VARIANT.match(stem)
+        if match and match.group(1) in self.sources:
+            return self.sources[match.group(1)], 'image'
+        return None, None
+
+    def getSourceLock(self, psd):
+        with self.lock:
+            return self.sourceLocks.setdefault(psd, threading.Lock())
+
+    def checkEntry(self, psd):
+        """Manifest entry of psd, or None if psd changed since its outputs
+        were made. Outputs of a changed source are removed."""
+        navzen = self.navzen
+        name = os.path.basename(psd)
+        stat = os.stat(psd)
+        with self.manifestLock:
+            entry = self.files.get(name)
+            if entry is None:
+                return None
+            if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                del self.files[name]
+                self.htmlDone.discard(name)
+                navzen.fileRecords.pop(psd, None)
+                navzen.formats.pop(psd, None)
+                navzen.sliceNames.pop(psd, None)
+                navzen.removeOutputs(entry.get('outputs', []))
+                self.push(psd, 1)
+                return None
+            if psd not in navzen.fileRecords:
+                navzen.fileRecords[psd] = {'size': entry['size'], 'mtime': entry['mtime'], 'hash': entry['hash']}
+                if entry.get('format'):
+                    navzen.formats[psd] = tuple(entry['format'])
+                if entry.get('slices'):
+                    navzen.sliceNames[psd] = list(entry['slices'])
+            return entry
+
+    def ensure(self, psd, kind):
+        """Makes the outputs of psd that a request of kind needs and are
+        missing or older than the source."""
+        navzen = self.navzen
+        name = os.path.basename(psd)
+        outputDirectory = navzen.a['outputDirectory']
+
+        # Plans hold full paths, slices and html names are relative to
+        # the output directory
+        def isMissing(names):
+            return any(os.path.isfile(os.path.join(outputDirectory, name)) == False for name in names)
+
+        def isMissingPlan(plan):
+            return any(os.path.isfile(output) == False for output, options in plan)
+
+        with self.getSourceLock(psd):
+            entry = self.checkEntry(psd)
+            image = thumb = html = False
+
+            # Mobile pages link to the stored slices, so they need them first
+            if kind == 'image' or kind == 'html' and navzen.a['mobile'] == True:
+                if navzen.a['mobile'] == True:
+                    image = entry is None or psd not in navzen.sliceNames or isMissing(navzen.sliceNames[psd])
+                else:
+                    image = entry is None or isMissingPlan(navzen.getImagePlan(psd))
+            if kind == 'thumb':
+                thumb = entry is None or isMissingPlan(navzen.getThumbnailPlan(psd))
+            if kind == 'html':
+                html = (image or entry is None or name not in self.htmlDone
+                        or entry['next'] != os.path.basename(navzen.getSideFile(psd, +1))
+                        or isMissing([navzen.changeExtension(name, "html")]))
+
+            if not (image or thumb or html):
+                return
+
+            plan = navzen.getPlan(psd, image, thumb)
+            if plan and not navzen.convert.render(psd, plan):
+                print("\nERROR: {0} could not be converted".format(name), file=sys.stderr)
+            navzen.storeOutputs(psd, plan, image)
+            if html:
+                navzen.createHtmlFromPSD(psd)
+            navzen.printProgress(psd, 1, 1)
+
+            with self.manifestLock:
+                self.files[name] = navzen.getManifestEntry(psd)
+                if html:
+                    self.htmlDone.add(name)
+                navzen.writeManifest(self.files)
+
+    def push(self, psd, priority):
+        """Queues the thumb of psd, lower priorities go first."""
+        with self.condition:
+            self.heapq.heappush(self.queue, (priority, next(self.order), psd))
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                priority, order, psd = self.heapq.heappop(self.queue)
+            try:
+                if os.path.isfile(psd):
+                    self.ensure(psd, 'thumb')
+            except Exception as e:
+                print("\nERROR: {0} {1}".format(os.path.basename(psd), e), file=sys.stderr)
+
+
+class Profiler(object):
+    """Per-stage timings and call counts for one build (--profile).
+
+    Stages are measured by wrapping the methods that implement them on
+    the objects being built, and filesystem and subprocess calls are
+    counted by wrapping the os and subprocess functions for the length
+    of the build. Nothing is wrapped without --profile, so profiling
+    costs nothing when it is off. Stage times are inclusive and, with
+    several jobs, add up the time of every worker.
+    """
+
+    # stage: Navzen methods
+    STAGES = [
+        ('scan', ['getFilesFromDirectory', 'getAllDirectoriesWithFormat']),
+        ('manifest', ['getPendingWork', 'saveManifest']),
+        ('html', ['createHtmlFromPSD']),
+        ('index', ['createIndex'])
+    ]
+
+    # Module names, so shutil is only imported when profiling
+    FILESYSTEM_CALLS = [
+        ('os', 'scandir'), ('os', 'listdir'), ('os', 'stat'), ('os', 'remove'), ('os', 'replace'),
+        ('os', 'link'), ('os', 'makedirs'), ('os.path', 'isfile'), ('os.path', 'isdir'), ('shutil', 'copy'),
+        ('shutil', 'copyfile')
+    ]
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.patched = []
+
+    def instrument(self, navzen):
+        for stage, methods in self.STAGES:
+            for method in methods:
+                self.wrapMethod(navzen, method, stage)
+
+    def instrumentProbe(self, probe):
+        # Header reads happen from Convert and srcset too, not only
+        # through Navzen.getImageSize
+        self.wrapMethod(probe, 'getInfo', 'probe')
+
+    def instrumentConvert(self, convert):
+        self.wrapMethod(convert, 'render', 'convert')
+        self.wrapMethod(convert, 'renderBatch', 'convert')
+
+    def instrumentCalls(self):
+        import importlib
+        import subprocess
+        for moduleName, name in self.FILESYSTEM_CALLS:
+            module = importlib.import_module(moduleName)
+            self.patch(module, name, self.getCounter(getattr(module, name), "fs." + name))
+
+        popenInit = subprocess.Popen.__init__
+        self.patch(subprocess.Popen, '__init__', self.getCounter(popenInit, "subprocess"))
+
+    def restore(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def patch(self, owner, name, replacement):
+        self.patched.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, replacement)
+
+    def wrapMethod(self, obj, name, stage):
+        method = getattr(obj, name)
+        profiler = self
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                profiler.record(stage, time.time() - start)
+
+        setattr(obj, name, timed)
+
+    def getCounter(self, function, name):
+        profiler = self
+
+        def counted(*args, **kwargs):
+            profiler.count(name)
+            return function(*args, **kwargs)
+
+        return counted
+
+    def record(self, stage, elapsed):
+        with self.lock:
+            calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (calls + 1, total + elapsed, max(longest, elapsed))
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def getReport(self):
+        stages = {}
+        for stage, (calls, total, longest) in self.stages.items():
+            stages[stage] = {'calls': calls, 'total': total, 'mean': total / calls, 'max': longest}
+        return {
+            'wall': time.time() - self.start,
+            'stages': stages,
+            'counters': dict(self.counters)
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.getReport(), f, indent=1, sort_keys=True)
+
+    def printSummary(self):
+        report = self.getReport()
+        print("\n\033[95mProfile\033[0m ({0:.2f} s wall)".format(report['wall']))
+        print("{0:<10} {1:>7} {2:>10} {3:>10} {4:>10}".format("stage", "calls", "total (s)", "mean (ms)", "max (ms)"))
+        for stage in sorted(report['stages'], key=lambda stage: -report['stages'][stage]['total']):
+            data = report['stages'][stage]
+            print("{0:<10} {1:>7} {2:>10.3f} {3:>10.2f} {4:>10.2f}".format(stage, data['calls'], data['total'], data['mean'] * 1000, data['max'] * 1000))
+        filesystem = sum(n for name, n in report['counters'].items() if name.startswith("fs."))
+        print("subprocesses {0}, filesystem calls {1}".format(report['counters'].get('subprocess', 0), filesystem))
+
+
+class Archive(object):
+    """Zip or tar file the generated files go into as they are made (--archive).
+
+    Files are added right after they are written, while they are still
+    in the page cache, and the files of the output directory that were
+    not made in this build (unchanged since the last one) are added on
+    close. Zip entries of already compressed images are stored, the rest
+    are deflated. Without `keep` every file is deleted from the output
+    directory once it is in the archive.
+
+    The archive is written next to its final name and only replaces it
+    on close.
+    """
+
+    STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif')
+    TAR_MODES = [('.tar', 'w'), ('.tar.gz', 'w:gz'), ('.tgz', 'w:gz'), ('.tar.bz2', 'w:bz2'), ('.tar.xz', 'w:xz')]
+
+    def __init__(self, path, root, keep=True):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.keep = keep
+        # The archive may live inside the output directory; it must not
+        # go into itself
+        self.own = set([os.path.abspath(path), os.path.abspath(path + ".tmp")])
+        self.added = set()
+        self.lock = threading.Lock()
+        self.zip = None
+        self.tar = None
+
+        name = path.lower()
+        if name.endswith('.zip'):
+            import zipfile
+            self.zip = zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_DEFLATED)
+            return
+        for extension, mode in self.TAR_MODES:
+            if name.endswith(extension):
+                import tarfile
+                self.tar = tarfile.open(path + ".tmp", mode)
+                return
+        raise ValueError("Unknown archive format {0}, use .zip, .tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz".format(path))
+
+    def add(self, path):
+        path = os.path.abspath(path)
+        if path in self.own:
+            return
+        name = os.path.relpath(path, self.root).replace(os.sep, "/")
+        with self.lock:
+            if name in self.added or os.path.isfile(path) == False:
+                return
+            if self.zip is not None:
+                import zipfile
+                stored = os.path.splitext(name)[1].lower() in self.STORED_EXTENSIONS
+                self.zip.write(path, name, zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+            else:
+                self.tar.add(path, name)
+            self.added.add(name)
+        if self.keep == False:
+            os.remove(path)
+
+    def close(self):
+        for directory, subdirectories, names in os.walk(self.root):
+            subdirectories[:] = sorted(d for d in subdirectories if d.startswith(".") == False)
+            for name in sorted(names):
+                if name.startswith(".") == False and name != PROFILE_FILE_NAME:
+                    self.add(os.path.join(directory, name))
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Template(object):
+    """A page template compiled into literal text and [navzen-*] slots.
+
+    The template is parsed once; rendering is a single join of the
+    literal parts with the slot values. Slots without a value keep their
+    tag text, like the old replace chains did. `elements` maps a slot
+    name to a regex for a whole element to turn into that slot, e.g. the
+    mobile <img> tag that is repeated once per slice; the element's own
+    markup is kept as a sub-template in `self.elements`.
+    """
+
+    TAG = re.compile(r"(\[navzen-[a-z0-9-]+\])")
+
+    def __init__(self, source, elements=None):
+        self.source = source
+        self.elements = {}
+
+        for name, pattern in (elements or {}).items():
+            match = re.search(pattern, source)
+            if match is not None:
+                self.elements[name] = Template(match.group())
+                source = source.replace(match.group(), "[{0}]".format(name))
+
+        self.parts = self.TAG.split(source)
+
+    def hasSlot(self, name):
+        return "[{0}]".format(name) in self.parts[1::2]
+
+    def stream(self, f, values):
+        """Writes the template to f. Values may be strings or iterables of
+        strings, which are written chunk by chunk as they are produced."""
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                f.write(part)
+                continue
+            value = values.get(part[1:-1])
+            if value is None:
+                f.write(part)
+            elif isinstance(value, str):
+                f.write(value)
+            else:
+                for chunk in value:
+                    f.write(chunk)
+
+    def render(self, values):
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            value = values.get(parts[i][1:-1])
+            if value is not None:
+                parts[i] = value
+        return "".join(parts)
+
+
+class FileIndex(object):
+    """Naturally sorted files of one directory with their neighbours.
+
+    The directory is read once with os.scandir (or the names come from a
+    tree walk that already read it), and the previous and next
+    file of every entry are precomputed so navigation lookups are O(1).
+    Navigation wraps around: the first file follows the last one.
+    """
+
+    def __init__(self, directory, extension, names=None):
+        self.directory = directory
+        self.extension = extension
+        extSize = len(extension)
+
+        if names is None:
+            names = [entry.name for entry in os.scandir(directory) if entry.is_file()]
+        names = [name for name in names if name[extSize*-1:] == extension]
+        names.sort(key=naturalKey)
+        self.files = [os.path.join(directory, name) for name in names]
+
+        self.sides = {}
+        total = len(self.files)
+        for i, filePath in enumerate(self.files):
+            self.sides[filePath] = (self.files[i - 1], self.files[(i + 1) % total])
+
+    def getSide(self, filePath, side):
+        try:
+            return self.sides[filePath][0 if side < 0 else 1]
+        except KeyError:
+            return self.files[0]
+
+
+def naturalKey(name):
+    """Sort key that orders "screen 2" before "screen 10"."""
+    parts = [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+    return parts, name
+
 
 class Navzen(object):
 
     def __init__(self):
-        self.convert = Convert()
+        self.probe = ImageProbe()
+        self.convert = Convert(probe=self.probe)
+        self.fileRecords = {}
+        self.fileIndexes = {}
+        self.templates = {}
+        self.tree = {}
+        self.sections = []
+        self.profiler = None
+        self.archive = None
+        self.formats = {}
+        self.formatSelector = None
+        self.sliceNames = {}
+        self.server = None
 
     def errprint(self, msg):
         """Custom error printing."""
@@ -113,43 +1928,139 @@ class Navzen(object):
 
     def directoryIsEmptyOfTypeFiles(self, path, typeOfFile):
 
-        ls = []
-        files = os.listdir(path)
-
-        for f in files:
-            if f.startswith(".") == False and self.private(f) == False:
-                    ls.append(f)
+        if path in self.tree:
+            names = self.tree[path]
+        else:
+            names = [entry.name for entry in os.scandir(path) if entry.is_file()]
 
-        for item in ls:
-            if os.path.isdir(os.path.join(path, item)) == False:
-                if os.path.splitext(os.path.join(path, item))[1] == typeOfFile:
+        for name in names:
+            if name.startswith(".") == False and self.private(name) == False:
+                if os.path.splitext(name)[1] == typeOfFile:
                     return False
 
         return True
 
 
     def getAllDirectoriesWithFormat(self, root, typeOfFile):
+        """Walks root once with os.scandir and returns the directories
+        that hold files of typeOfFile (".png"...). Hidden and __private
+        directories are skipped with everything below them, and so is
+        the output directory."""
+
+        self.tree = {}
+        skip = os.path.abspath(self.a['outputDirectory']) if self.a.get('outputDirectory') else None
+        stack = [root]
+
+        while stack:
+            directory = stack.pop()
+            names = []
+            subdirectories = []
+            for entry in os.scandir(directory):
+                if entry.is_dir():
+                    if entry.name.startswith(".") == False and self.private(entry.name) == False and os.path.abspath(entry.path) != skip:
+                        subdirectories.append(entry.path)
+                elif entry.is_file():
+                    names.append(entry.name)
+            self.tree[directory] = names
+            stack.extend(sorted(subdirectories, key=naturalKey, reverse=True))
 
-        roots = []
         rootsFiletered = []
+        for directory in self.tree:
+            if self.directoryIsEmptyOfTypeFiles(directory, typeOfFile) == False:
+                rootsFiletered.append(directory)
 
-        # Get all dirs
-        for root, dirs, files in os.walk(root):
-            roots.append(root)
+        return rootsFiletered
 
-        # Remove empty dirs and start with __
-        for i in range(len(roots)):
-            directory = roots[i]
 
-            if self.directoryIsEmptyOfTypeFiles(directory, typeOfFile) == False:
-                if self.private(directory) == False:
-                    rootsFiletered.append(directory)
+    def createRecursive(self):
+        """Builds every subdirectory with input files in one run.
 
-        return rootsFiletered
+        Each directory gets its own pages and index under the same
+        relative path of the output directory, all files share one worker
+        pool, and the top index lists the files of the root directory (if
+        any) followed by a link to every section.
+        """
+        root = self.a['inputDirectory']
+        directories = self.getAllDirectoriesWithFormat(root, "." + self.a['inputformat'])
+
+        if len(directories) == 0:
+            self.errprint("There are no {0} files in {1}".format(self.a['inputformat'], root))
+            return
+
+        builders = []
+        for directory in directories:
+            names = self.tree[directory]
+            self.fileIndexes[(os.path.normpath(directory), self.a['inputformat'])] = FileIndex(directory, self.a['inputformat'], names)
+            if os.path.normpath(directory) == os.path.normpath(root):
+                builders.append(self)
+            else:
+                builders.append(self.getChild(directory, os.path.join(self.a['outputDirectory'], os.path.relpath(directory, root))))
+
+        try:
+            work = []
+            manifests = []
+            for builder in builders:
+                allpsds = builder.getFilesFromDirectory(builder.a['inputDirectory'], self.a['inputformat'])
+                manifest = builder.loadManifest()
+                manifests.append((builder, allpsds, manifest))
+                work += builder.getPendingWork(allpsds, manifest)
+
+            self.buildAssets(work)
+
+            self.sections = []
+            for builder, allpsds, manifest in manifests:
+                builder.saveManifest(allpsds, manifest)
+                if builder is not self:
+                    builder.createIndex()
+                    self.sections.append(builder.getSection(root, allpsds[0]))
+
+            print ("")
+
+        except KeyboardInterrupt:
+            errprint("\033[91mInterrupted by you\033[0m")
+
+
+    def getChild(self, inputDirectory, outputDirectory):
+        """A Navzen for one subdirectory that shares the converter,
+        caches and templates of this one."""
+        child = Navzen()
+        child.a = dict(self.a, psdFile=inputDirectory, inputDirectory=inputDirectory, outputDirectory=outputDirectory, recursive=False)
+        child.convert = self.convert
+        child.probe = self.probe
+        child.fileIndexes = self.fileIndexes
+        child.templates = self.templates
+        child.profiler = self.profiler
+        child.archive = self.archive
+        child.formats = self.formats
+        child.formatSelector = self.formatSelector
+        if self.profiler is not None:
+            self.profiler.instrument(child)
+
+        if os.path.isdir(outputDirectory) == False:
+            os.makedirs(outputDirectory)
+        child.copyLibrarys()
+        return child
+
+
+    def getSection(self, root, firstPsd):
+        """(dataTags, thumb, href) of the top index entry for this directory."""
+        relative = os.path.relpath(self.a['inputDirectory'], root).replace(os.sep, "/")
+        return (
+            " ".join(t for t in re.split(r"[/ -]", relative) if t != "" and t != "_"),
+            "{0}/{1}_thumb.{2}".format(relative, os.path.splitext(os.path.basename(firstPsd))[0], self.getOutputFormat(firstPsd)),
+            "{0}/{1}".format(relative, INDEX_PAGE_NAME)
+        )
 
 
     def export(self, command):
 
+        # Without an output directory the files only live until they are archived
+        if self.a.get('archiveOnly') == True:
+            if not self.a.get('archive'):
+                self.errprint("--archive-only needs --archive=FILE")
+            import tempfile
+            self.a['outputDirectory'] = tempfile.mkdtemp(prefix="navzen-")
+
         # Set outputdirectory
         # Si no se ha especificado directorio de salida...
         # ...añadimos uno por defecto
@@ -170,6 +2081,42 @@ class Navzen(object):
         else:
             self.a['inputDirectory'] = os.path.dirname(self.a['psdFile'])
 
+        # image backend and shared render cache
+        cache = None
+        if self.a.get('cacheDirectory'):
+            cache = RenderCache(self.a['cacheDirectory'], int(self.a.get('cacheSize') or 0) * 1024 * 1024)
+        try:
+            self.convert = Convert(self.a.get('backend') or 'imagemagick', cache, self.probe)
+        except ValueError as e:
+            self.errprint(e)
+
+        if self.a.get('srcset'):
+            try:
+                parseSrcset(self.a['srcset'])
+            except ValueError as e:
+                self.errprint(e)
+
+        # archive the files as they are made
+        if self.a.get('archive'):
+            try:
+                self.archive = Archive(self.a['archive'], self.a['outputDirectory'], keep=self.a.get('archiveOnly') != True)
+            except ValueError as e:
+                self.errprint(e)
+
+        # per-stage timings
+        if self.a.get('profile') == True:
+            self.profiler = Profiler()
+            self.profiler.instrument(self)
+            self.profiler.instrumentProbe(self.probe)
+            self.profiler.instrumentConvert(self.convert)
+            self.profiler.instrumentCalls()
+
+        # one directory scan per build
+        self.fileIndexes = {}
+
+        # image sizes from previous builds
+        self.probe.load(os.path.join(self.a['outputDirectory'], PROBE_CACHE_FILE_NAME))
+
         # copy library files
         self.copyLibrarys()
 
@@ -181,7 +2128,7 @@ class Navzen(object):
         print("Simple HTML Navigation from images", end="\n\n")
         print("Convert formats: {0} to {1}".format(self.a['inputformat'], self.a['outputformat']), end="\n")
         print("Source Path {0}".format(self.a['psdFile']), end="\n")
-        print("Destination Path {0}".format(self.a['outputDirectory']), end="\n\n")
+        print("Destination Path {0}".format(self.a['archive'] if self.a.get('archiveOnly') == True else self.a['outputDirectory']), end="\n\n")
 
         if command == 'update':
             self.update()
@@ -189,33 +2136,55 @@ class Navzen(object):
         if command == 'create':
             self.create()
 
+        if command == 'watch':
+            self.watch()
+
+        if command == 'serve':
+            self.serve()
+
         # rebuild index
         self.createIndex()
 
+        self.probe.save()
+
+        if self.convert.cache is not None:
+            self.convert.cache.trim()
+
+        profileDirectory = self.a['outputDirectory']
+        if self.archive is not None:
+            self.archive.close()
+            if self.a.get('archiveOnly') == True:
+                import shutil
+                shutil.rmtree(self.a['outputDirectory'], ignore_errors=True)
+                profileDirectory = os.path.dirname(os.path.abspath(self.a['archive']))
+
         # final info
         if not self.a['quiet'] and not self.a['kiet']:
             print("", end="\n")
-            print("Mockup finished at {0}".format(os.path.abspath(self.a['outputDirectory'])), end="\n\n\033[0m")
+            print("Mockup finished at {0}".format(os.path.abspath(self.a['archive'] if self.a.get('archiveOnly') == True else self.a['outputDirectory'])), end="\n\n\033[0m")
+
+        if self.profiler is not None:
+            self.profiler.restore()
+            self.profiler.save(os.path.join(profileDirectory, PROFILE_FILE_NAME))
+            self.profiler.printSummary()
 
 
     def create(self):
 
         self.a['inputDirectory'] = self.a['psdFile']
 
+        if self.a.get('recursive') == True:
+            return self.createRecursive()
+
         allpsds = self.getFilesFromDirectory(self.a['inputDirectory'], self.a['inputformat'])
 
         if len(allpsds) > 0:
 
             try:
-                i = 1
-                for psd in allpsds:
-                    self.a['psdFile'] = psd
-                    self.update(create=True, totalFiles=len(allpsds), currentFile=i)
-                    i+=1
-
-                    if self.a['quiet'] == True and self.a['kiet'] == False:
-                        sys.stdout.write("\rConverting {}%".format(str(int((100/len(allpsds))*(i-1)))))
-                        sys.stdout.flush()
+                manifest = self.loadManifest()
+                work = self.getPendingWork(allpsds, manifest)
+                self.buildAssets(work)
+                self.saveManifest(allpsds, manifest)
 
                 print ("")
 
@@ -227,6 +2196,296 @@ class Navzen(object):
             return
 
 
+    def watch(self):
+        """Builds the navigation and keeps it up to date.
+
+        After a burst of saves settles, only the changed files, the html
+        of their neighbours and the index are regenerated (see
+        getPendingWork).
+        """
+        watcher = Watcher(self.a['psdFile'], self.a['inputformat'])
+
+        self.create()
+        self.createIndex()
+        self.probe.save()
+
+        print("Watching {0} ({1}), press Ctrl+C to stop".format(self.a['inputDirectory'], watcher.getMode()))
+        try:
+            while True:
+                changed = watcher.wait()
+                print("\n\033[95mChanged\033[0m {0}".format(", ".join(sorted(changed))))
+                self.fileIndexes = {}
+                # All screens moved or renamed at once: wait for them
+                # to come back instead of leaving through errprint
+                if len(self.getFilesFromDirectory(self.a['inputDirectory'], self.a['inputformat'])) == 0:
+                    print("There are no {0} files in {1}, waiting".format(self.a['inputformat'], self.a['inputDirectory']))
+                    continue
+                self.loadTemplates()
+                self.create()
+                self.createIndex()
+                self.probe.save()
+        except KeyboardInterrupt:
+            print("")
+        finally:
+            watcher.close()
+
+
+    def serve(self):
+        """Serves the navigation, making each file the first time it is
+        requested (see Server)."""
+        try:
+            server = Server(self, int(self.a.get('port') or SERVE_PORT))
+        except OSError as e:
+            self.errprint(e)
+
+        print("Serving {0} at {1}, press Ctrl+C to stop".format(self.a['inputDirectory'], server.getURL()))
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            print("")
+        finally:
+            server.close()
+
+
+    def getJobs(self):
+        jobs = int(self.a.get('jobs') or 1)
+        if jobs <= 0:
+            jobs = os.cpu_count() or 1
+        return jobs
+
+
+    def buildAssets(self, work):
+        """Builds a list of (owner, psdFile, image, thumb, html) work items.
+
+        `owner` is the Navzen that plans the file, which differs from self
+        for subdirectories in recursive builds.
+
+        With more than one job the items run across a bounded pool of
+        workers. Each file only writes its own image, thumb, slices and
+        html, so the output is the same as a serial run. Progress is
+        reported in the order the files finish.
+
+        In batch mode the items are grouped so that each group of sources
+        is converted by a single ImageMagick process.
+        """
+        if len(work) == 0:
+            return
+
+        lock = threading.Lock()
+        done = [0]
+
+        def progress(psd):
+            with lock:
+                done[0] += 1
+                self.printProgress(psd, len(work), done[0])
+
+        def build(item):
+            owner, psd, image, thumb, html = item
+            owner.createAsset(psd, image=image, thumb=thumb, html=html)
+            progress(psd)
+
+        def buildBatch(batch):
+            plans = [(psd, owner.getPlan(psd, image, thumb)) for owner, psd, image, thumb, html in batch]
+            failed = self.convert.renderBatch([(psd, plan) for psd, plan in plans if plan])
+            for (owner, psd, image, thumb, html), (psd, plan) in zip(batch, plans):
+                owner.storeOutputs(psd, plan, image)
+            for owner, psd, image, thumb, html in batch:
+                if psd in failed:
+                    print("\nERROR: {0} could not be converted".format(os.path.basename(psd)), file=sys.stderr)
+                if html:
+                    owner.createHtmlFromPSD(psd)
+                progress(psd)
+
+        items = work
+        func = build
+        if self.a.get('batch') == True:
+            size = max(1, min(BATCH_SIZE, int(math.ceil(len(work) / self.getJobs()))))
+            items = [work[i:i+size] for i in range(0, len(work), size)]
+            func = buildBatch
+
+        if self.getJobs() == 1 or len(items) == 1:
+            for item in items:
+                func(item)
+            return
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.getJobs(), len(items)))
+        try:
+            pool.map(func, items, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def getBuildOptions(self):
+        """Options that change the generated files. If any of them differs
+        from the manifest, every file is rebuilt."""
+        return {
+            'inputformat': self.a['inputformat'],
+            'outputformat': self.a['outputformat'],
+            'quality': self.a['quality'],
+            'resize': self.a['resize'],
+            'mobile': self.a['mobile'],
+            'sliceSize': int(self.a['sliceSize']),
+            'backend': self.a.get('backend') or 'imagemagick',
+            'srcset': self.a.get('srcset')
+        }
+
+
+    def loadManifest(self):
+        path = os.path.join(self.a['outputDirectory'], MANIFEST_FILE_NAME)
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get('version') != MANIFEST_VERSION:
+                return {}
+            return manifest
+        except (IOError, OSError, ValueError):
+            return {}
+
+
+    def saveManifest(self, allpsds, manifest):
+        files = {}
+        for psd in allpsds:
+            files[os.path.basename(psd)] = self.getManifestEntry(psd)
+
+        # Remove outputs of files that no longer exist
+        for name, entry in manifest.get('files', {}).items():
+            if name not in files:
+                self.removeOutputs(entry.get('outputs', []))
+        self.collectSlices(files)
+
+        self.writeManifest(files)
+
+
+    def writeManifest(self, files):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'options': self.getBuildOptions(),
+            'template': self.getTemplateHash(),
+            'files': files
+        }
+
+        path = os.path.join(self.a['outputDirectory'], MANIFEST_FILE_NAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+    def getManifestEntry(self, psdFile):
+        if psdFile not in self.fileRecords:
+            stat = os.stat(psdFile)
+            self.fileRecords[psdFile] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'hash': self.getFileHash(psdFile)
+            }
+        entry = dict(self.fileRecords[psdFile])
+        entry['prev'] = os.path.basename(self.getSideFile(psdFile, -1))
+        entry['next'] = os.path.basename(self.getSideFile(psdFile, +1))
+        entry['outputs'] = self.getOutputs(psdFile)
+        if self.a['outputformat'] == 'auto':
+            entry['format'] = list(self.getFormatChoice(psdFile))
+        if self.a['mobile'] == True and psdFile in self.sliceNames:
+            entry['slices'] = self.sliceNames[psdFile]
+        return entry
+
+
+    def getFileHash(self, psdFile):
+        return getFileHash(psdFile)
+
+
+    def getTemplateHash(self):
+        return hashlib.sha1(self.a['template'].source.encode("utf-8")).hexdigest()
+
+
+    def getOutputs(self, psdFile):
+        """Names of the files generated for psdFile, relative to the output directory."""
+        plan = self.getImagePlan(psdFile, slice=self.a['mobile'] == True) + self.getThumbnailPlan(psdFile)
+        outputs = [os.path.basename(output) for output, options in plan]
+        if self.a['mobile'] == True and psdFile in self.sliceNames:
+            outputs = self.sliceNames[psdFile] + outputs[-1:]
+        outputs.append(self.changeExtension(os.path.basename(psdFile), "html"))
+        return outputs
+
+
+    def removeOutputs(self, outputs):
+        for name in outputs:
+            # Stored slices may be shared, collectSlices removes them
+            if name.startswith(SLICE_STORE + "/"):
+                continue
+            path = os.path.join(self.a['outputDirectory'], name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+    def getPendingWork(self, allpsds, manifest):
+        """Compares the sources with the manifest of the previous build and
+        returns the work needed to bring the output directory up to date.
+
+        Changed files get all their assets rebuilt. Files whose neighbours
+        changed only get their html rewritten, since the html links to the
+        next page. Unchanged files with missing outputs only get those
+        outputs made again.
+        """
+        self.fileRecords = {}
+        oldFiles = manifest.get('files', {})
+        rebuildAll = self.a.get('force') == True or manifest.get('options') != self.getBuildOptions()
+        rebuildHtml = rebuildAll or manifest.get('template') != self.getTemplateHash()
+
+        work = []
+        for psd in allpsds:
+            name = os.path.basename(psd)
+            entry = oldFiles.get(name)
+            stat = os.stat(psd)
+
+            changed = rebuildAll or entry is None
+            if not changed and (entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime):
+                # Touched but maybe not modified, the hash decides
+                fileHash = self.getFileHash(psd)
+                changed = fileHash != entry['hash']
+                self.fileRecords[psd] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': fileHash}
+            elif not changed:
+                self.fileRecords[psd] = {'size': entry['size'], 'mtime': entry['mtime'], 'hash': entry['hash']}
+
+            # Formats picked by auto and stored slices are kept until the source changes
+            self.formats.pop(psd, None)
+            self.sliceNames.pop(psd, None)
+            if not changed and entry.get('format'):
+                self.formats[psd] = tuple(entry['format'])
+            if not changed and entry.get('slices'):
+                self.sliceNames[psd] = list(entry['slices'])
+
+            outputs = self.getOutputs(psd)
+            missing = []
+            if not changed:
+                missing = [output for output in outputs if os.path.isfile(os.path.join(self.a['outputDirectory'], output)) == False]
+
+            if changed:
+                if entry is not None:
+                    self.removeOutputs([o for o in entry.get('outputs', []) if o not in outputs])
+                work.append((self, psd, True, True, True))
+            elif missing or rebuildHtml or entry['prev'] != os.path.basename(self.getSideFile(psd, -1)) or entry['next'] != os.path.basename(self.getSideFile(psd, +1)):
+                # Unchanged source: only the missing outputs are made again,
+                # so a lost thumbnail doesn't cost a decode of the source
+                thumbName = os.path.basename(self.getThumbnailPlan(psd)[0][0])
+                htmlName = outputs[-1]
+                image = any(output not in (thumbName, htmlName) for output in missing)
+                work.append((self, psd, image, thumbName in missing, True))
+            elif self.a['quiet'] == False and self.a['kiet'] == False:
+                print ("\033[93m(Skip) " + name)
+
+        return work
+
+
+    def printProgress(self, psdFile, totalFiles, currentFile):
+        if self.a['quiet'] == False and self.a['kiet'] == False:
+            print ("\033[92m{:03d} % ... {}".format(int((100/totalFiles)*currentFile), os.path.basename(psdFile)))
+        elif self.a['kiet'] == False:
+            sys.stdout.write("\rConverting {}%".format(str(int((100/totalFiles)*currentFile))))
+            sys.stdout.flush()
+
+
     def update(self, create=False, totalFiles=1, currentFile=1):
 
         # Obtenemos el archivo anterior y posterior al actual
@@ -252,39 +2511,113 @@ class Navzen(object):
     def loadTemplates(self):
 
         if self.a['mobile']:
-            self.a['template'] = self.loadTemplate(MOBILE_HTML_SHEET)
+            self.a['template'] = Template(self.loadTemplate(MOBILE_HTML_SHEET), {'navzen-img-tag': IMG_TAG})
         else:
-            self.a['template'] = self.loadTemplate(DESKTOP_HTML_SHEET)
+            self.a['template'] = Template(self.loadTemplate(DESKTOP_HTML_SHEET), {'navzen-img-tag': IMG_TAG} if self.a.get('srcset') else None)
 
-        self.a['indexTemplate'] = self.loadTemplate(INDEX_HTML_SHEET)
+        self.a['indexTemplate'] = Template(self.loadTemplate(INDEX_HTML_SHEET))
 
 
     def loadTemplate(self, fileTemplate):
+        """Reads a template, reusing the last read while the file is unchanged."""
         try:
+            mtime = os.stat(fileTemplate).st_mtime
+            cached = self.templates.get(fileTemplate)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
             file_html = open(fileTemplate, "r")
             content = file_html.read()
             file_html.close()
             if "[navzen-" not in content:
                 return False
+            self.templates[fileTemplate] = (mtime, content)
             return content
         except:
             self.errprint("El archivo {0} no existe o no puede abrirse".format(fileTemplate))
 
 
     def createAsset(self, psdFile, image=True, thumb=True, html=True):
-        if image:
-            if self.a['mobile'] == True:
-                self.createImageFromPSD(psdFile, slice=True)
-            else:
-                self.createImageFromPSD(psdFile)
-        if thumb:
-            self.createThumbnailFromPSD(psdFile)
+        # Image, slices and thumb come out of a single decode
+        plan = self.getPlan(psdFile, image, thumb)
+        if not self.convert.render(psdFile, plan):
+            print("\nERROR: {0} could not be converted".format(os.path.basename(psdFile)), file=sys.stderr)
+        self.storeOutputs(psdFile, plan, image)
         if html:
             if self.a['mobile'] == True:
                 pass
             self.createHtmlFromPSD(psdFile)
 
 
+    def storeOutputs(self, psdFile, plan, image=True):
+        """Moves freshly rendered slices into the slice store and adds the
+        outputs of plan to the archive."""
+        outputs = [output for output, options in plan]
+        if image and self.a['mobile'] == True:
+            outputs += self.storeSlices(psdFile)
+        self.addToArchive(outputs)
+
+
+    def storeSlices(self, psdFile):
+        """Keeps each slice of psdFile once, in SLICE_STORE inside the
+        output directory, named by the sha1 of its content.
+
+        Identical slices, from the same screen or from any other, end up
+        as a single file that every page links to, and a slice that is
+        already in the store is not written again. The store names are
+        kept in the manifest; unused ones go in collectSlices. Returns
+        the paths of the stored slices.
+        """
+        store = os.path.join(self.a['outputDirectory'], SLICE_STORE)
+        if os.path.isdir(store) == False:
+            os.makedirs(store, exist_ok=True)
+
+        names = []
+        for outputFile, options in self.getImagePlan(psdFile, slice=True):
+            if os.path.isfile(outputFile) == False:
+                # Failed render, pages link to the plain slice names
+                self.sliceNames.pop(psdFile, None)
+                return []
+            sha = hashlib.sha1()
+            with open(outputFile, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+            name = "{0}/{1}{2}".format(SLICE_STORE, sha.hexdigest()[:20], os.path.splitext(outputFile)[1])
+            path = os.path.join(self.a['outputDirectory'], name)
+            if os.path.isfile(path):
+                os.remove(outputFile)
+            else:
+                os.replace(outputFile, path)
+            names.append(name)
+
+        self.sliceNames[psdFile] = names
+        return [os.path.join(self.a['outputDirectory'], name) for name in names]
+
+
+    def collectSlices(self, files):
+        """Removes the slices of the store that no page links to."""
+        store = os.path.join(self.a['outputDirectory'], SLICE_STORE)
+        if os.path.isdir(store) == False:
+            return
+        used = set(os.path.basename(name) for entry in files.values() for name in entry.get('slices', []))
+        for entry in os.scandir(store):
+            if entry.is_file() and entry.name not in used:
+                os.remove(entry.path)
+        if len(used) == 0 and len(os.listdir(store)) == 0:
+            os.rmdir(store)
+
+
+    def getPlan(self, psdFile, image=True, thumb=True):
+        plan = []
+        if image:
+            if self.a['mobile'] == True:
+                plan += self.getImagePlan(psdFile, slice=True)
+            else:
+                plan += self.getImagePlan(psdFile)
+        if thumb:
+            plan += self.getThumbnailPlan(psdFile)
+        return plan
+
+
     def getSlices(self, height, sliceSize):
         height = int(height)
         sliceSize = int(sliceSize)
@@ -301,66 +2634,203 @@ class Navzen(object):
 
 
     def createImageFromPSD(self, psdFile, slice=False):
+        self.convert.render(psdFile, self.getImagePlan(psdFile, slice))
+
+
+    def getImagePlan(self, psdFile, slice=False):
 
         if slice == False:
 
-            self.convert.do(self.a['psdFile'],
+            outputFormat, lossless = self.getFormatChoice(psdFile)
+            plan = [(
                 os.path.splitext(
-                    os.path.join(self.a['outputDirectory'], self.changeExtension(os.path.basename(self.a['psdFile']), self.a['outputformat'] ))
-                )[0] + "." + self.a['outputformat'],
+                    os.path.join(self.a['outputDirectory'], self.changeExtension(os.path.basename(psdFile), outputFormat ))
+                )[0] + "." + outputFormat,
                 {
                     'quality':self.a['quality'],
                     'resize':self.a['resize'],
-                    'crop':'100%'
+                    'crop':'100%',
+                    'lossless': lossless
 
                 }
-            )
+            )]
+
+            # Smaller copies for srcset come out of the same decode
+            for name, width, descriptor in self.getSrcsetVariants(psdFile)[0]:
+                plan.append((
+                    os.path.join(self.a['outputDirectory'], name),
+                    {
+                        'quality': self.a['quality'],
+                        'resize': '{0}x'.format(width),
+                        'crop': '100%',
+                        'lossless': lossless
+                    }
+                ))
+
+            return plan
 
         else:
 
+            # Slices are cut from the resized image, so they are measured
+            # in resized pixels
+            outputFormat, lossless = self.getFormatChoice(psdFile)
             size = self.getImageSize(psdFile)
-            width = size[0]
-            height = size[1]
+            width, height = getResizedSize(size[0], size[1], self.a['resize'])
             slices = self.getSlices(height, self.a['sliceSize'])
 
+            plan = []
             i = 0
             for slicePixels in slices:
 
                 output = "{0}_slice_{1}.{2}".format(
-                        os.path.join(self.a['outputDirectory'], os.path.splitext(os.path.basename(self.a['psdFile']))[0]),
+                        os.path.join(self.a['outputDirectory'], os.path.splitext(os.path.basename(psdFile))[0]),
                         str(i),
-                        self.a['outputformat']
+                        outputFormat
                 )
 
                 crop = '{0}x{1}+{2}+{3}'.format(int(width), slices[i], 0, int(i * int(self.a['sliceSize'])))
 
-                self.convert.do(
-                    self.a['psdFile'],
+                plan.append((
                     output,
                     {
                         'resize': self.a['resize'],
                         'crop': crop,
-                        'quality': self.a['quality']
+                        'quality': self.a['quality'],
+                        'lossless': lossless
                     }
-                )
+                ))
 
                 i += 1
 
+            return plan
+
+
+    def getSliceFiles(self, psdFile):
+        """(file name, width, height) of every slice of psdFile, with the
+        size each slice has once resized and cropped."""
+        size = self.getImageSize(psdFile)
+        plan = self.getImagePlan(psdFile, slice=True)
+        names = self.sliceNames.get(psdFile)
+        if names is None or len(names) != len(plan):
+            names = [os.path.basename(output) for output, options in plan]
+        files = []
+        for name, (output, options) in zip(names, plan):
+            width, height = getResizedSize(size[0], size[1], options['resize'])
+            left, top, right, bottom = getCropBox(width, height, options['crop'])
+            files.append((name, right - left, bottom - top))
+        return files
+
+
+    def getSliceTags(self, psdFile, values):
+        """One <img> per slice with its width and height, so the page
+        does not shift while loading. Slices below the first EAGER_SLICES
+        are lazy loaded.
+
+        If the template's img tag uses [navzen-slice-width],
+        [navzen-slice-height] or [navzen-slice-loading], it is rendered
+        for every slice with [navzen-img] as the slice file; otherwise a
+        plain tag is written.
+        """
+        element = self.a['template'].elements.get('navzen-img-tag')
+        custom = element is not None and any(element.hasSlot(slot) for slot in SLICE_SLOTS)
+
+        tags = []
+        for i, (name, width, height) in enumerate(self.getSliceFiles(psdFile)):
+            loading = '' if i < EAGER_SLICES else 'loading="lazy" decoding="async"'
+            if custom:
+                tags.append(element.render(dict(values, **{
+                    'navzen-img': name,
+                    'navzen-slice-width': str(width),
+                    'navzen-slice-height': str(height),
+                    'navzen-slice-loading': loading
+                })))
+            else:
+                tags.append('<img src="{0}" width="{1}" height="{2}"{3}>'.format(name, width, height, ' ' + loading if loading else ''))
+        return tags
+
+
+    def getSrcsetVariants(self, psdFile):
+        """Extra widths of the desktop image of psdFile for --srcset.
+
+        Returns a list of (file name, width, descriptor), smallest first,
+        and the descriptor of the full size image. Widths that are not
+        smaller than the image are left out. With densities ("1x,2x") the
+        full image is the highest density.
+        """
+        if not self.a.get('srcset'):
+            return [], None
+
+        kind, values = parseSrcset(self.a['srcset'])
+        size = self.getImageSize(psdFile)
+        width = getResizedSize(size[0], size[1], self.a['resize'])[0]
+        name = os.path.splitext(os.path.basename(psdFile))[0]
+
+        variants = []
+        if kind == 'x':
+            top = values[-1]
+            for density in values[:-1]:
+                variants.append((int(width * density / top + 0.5), "{0:g}x".format(density)))
+            full = "{0:g}x".format(top)
+        else:
+            for variantWidth in values:
+                if variantWidth < width:
+                    variants.append((variantWidth, "{0}w".format(variantWidth)))
+            full = "{0}w".format(width)
+
+        return [("{0}-{1}w.{2}".format(name, w, self.getOutputFormat(psdFile)), w, descriptor) for w, descriptor in variants], full
+
+
+    def getSrcsetTag(self, psdFile, values):
+        """The template's <img> tag with srcset and sizes attributes."""
+        variants, full = self.getSrcsetVariants(psdFile)
+        candidates = [getSrcsetCandidate(name, descriptor) for name, width, descriptor in variants]
+        candidates.append(getSrcsetCandidate(values['navzen-img'], full))
+
+        size = self.getImageSize(psdFile)
+        width = getResizedSize(size[0], size[1], self.a['resize'])[0]
+        attributes = ' srcset="{0}"'.format(", ".join(candidates))
+        if full.endswith("w"):
+            attributes += ' sizes="(max-width: {0}px) 100vw, {0}px"'.format(width)
+
+        tag = self.a['template'].elements['navzen-img-tag'].render(values)
+        return re.sub(r"\s*/?>$", lambda end: attributes + end.group(), tag, count=1)
+
+
+    def getFormatChoice(self, psdFile):
+        """(format, lossless) of the outputs of psdFile. With
+        --outputformat auto it is picked per source by FormatSelector."""
+        if self.a['outputformat'] != 'auto':
+            return self.a['outputformat'], False
+        if psdFile not in self.formats:
+            if self.formatSelector is None:
+                self.formatSelector = FormatSelector(self.a['quality'], self.probe, formats=self.convert.backend.getFormats())
+            self.formats[psdFile] = self.formatSelector.choose(psdFile)
+        return self.formats[psdFile]
+
+
+    def getOutputFormat(self, psdFile):
+        return self.getFormatChoice(psdFile)[0]
+
 
     def createThumbnailFromPSD(self, psdFile):
-        # large image
-        self.convert.do(self.a['psdFile'],
+        self.convert.render(psdFile, self.getThumbnailPlan(psdFile))
 
+
+    def getThumbnailPlan(self, psdFile):
+        # large image
+        outputFormat, lossless = self.getFormatChoice(psdFile)
+        return [(
             os.path.splitext(
-                os.path.join(self.a['outputDirectory'], self.changeExtension(os.path.basename(self.a['psdFile']), self.a['outputformat'] ))
-            )[0] + "_thumb." + self.a['outputformat'],
+                os.path.join(self.a['outputDirectory'], self.changeExtension(os.path.basename(psdFile), outputFormat ))
+            )[0] + "_thumb." + outputFormat,
             {
                 'quality':'100',
                 'resize':'120x',
-                'crop':'120x120+0+0'
+                'crop':'120x120+0+0',
+                'lossless': lossless
 
             }
-        )
+        )]
 
 
     def createHtmlFromPSD(self, psdFile, slice=False):
@@ -369,61 +2839,125 @@ class Navzen(object):
         size = self.getImageSize(psdFile)
         width = size[0]
         height = size[1]
-        slices = self.getSlices(height, self.a['sliceSize'])
 
-        # Replace custom tags with real content
-        tags = self.a['template']
-        tags = tags.replace("[navzen-title]", "Navzen")
-        tags = tags.replace("[navzen-img-width]", str(width))
-        tags = tags.replace("[navzen-img-height]", str(height))
-        tags = tags.replace("[navzen-next-html]", self.changeExtension(os.path.basename(self.getSideFile(psdFile, 1)), 'html'))
+        # Fill the template slots with real content
+        values = {
+            'navzen-title': "Navzen",
+            'navzen-img-width': str(width),
+            'navzen-img-height': str(height),
+            'navzen-next-html': self.changeExtension(os.path.basename(self.getSideFile(psdFile, 1)), 'html')
+        }
 
         if self.a['mobile'] == True:
 
-            templateImgTag = re.search("<[^>]+\[navzen-img\][^>]+>", tags).group()
-
-            i = 0
-            imageTags = ""
-            for slicePixels in slices:
-                imageTags += '<img src=\"{0}_slice_{1}.{2}\">'.format(
-                    os.path.splitext(os.path.basename(psdFile))[0],
-                    str(i),
-                    self.a['outputformat']
-                )
-                i +=1
-
-            tags = tags.replace(templateImgTag, imageTags)
+            # The img tag of the template is repeated once per slice
+            values['navzen-img-tag'] = "".join(self.getSliceTags(psdFile, values))
+            values['navzen-slices'] = values['navzen-img-tag']
 
         # Desktop
         else:
-            tags = tags.replace("[navzen-img]", self.changeExtension(os.path.basename(psdFile), self.a['outputformat']))
-        html = open(
-            os.path.join(
-                self.a['outputDirectory'],
-                self.changeExtension(os.path.basename(psdFile), "html")
-            ),
-            "w"
+            values['navzen-img'] = self.changeExtension(os.path.basename(psdFile), self.getOutputFormat(psdFile))
+            if 'navzen-img-tag' in self.a['template'].elements:
+                values['navzen-img-tag'] = self.getSrcsetTag(psdFile, values)
+        tags = self.a['template'].render(values)
+        path = os.path.join(
+            self.a['outputDirectory'],
+            self.changeExtension(os.path.basename(psdFile), "html")
         )
+        html = open(getTempPath(path), "w")
 
         html.write(tags)
         html.close()
+        commitFile(html.name, path)
+        self.addToArchive([path])
 
 
     def createIndex(self):
+        """Writes the index straight to disk, one item at a time.
 
-        indexPageLinks = ""
+        With an index page size the items are split into index.html,
+        index-2.html... linked with a pager. The pager goes into the
+        [navzen-index-pager] slot or, if the template has none, at the end
+        of the item list.
+        """
         allpsds = self.getFilesFromDirectory(self.a['inputDirectory'], self.a['inputformat'])
-        for psd in allpsds:
+        entries = [self.getIndexEntry(psd) for psd in allpsds] + self.sections
+        pageSize = int(self.a.get('indexPageSize') or 0) or max(1, len(entries))
+        pages = [entries[i:i+pageSize] for i in range(0, len(entries), pageSize)] or [[]]
+        template = self.a['indexTemplate']
+
+        for number, pageEntries in enumerate(pages, 1):
+            items = (self.getIndexItem(*entry) for entry in pageEntries)
+            pager = self.getIndexPager(number, len(pages))
+
+            # Replace custom tags with real content
+            values = {
+                'navzen-title': "TITULO",
+                'navzen-li-result': items,
+                'navzen-index-pager': pager
+            }
+            if not template.hasSlot('navzen-index-pager'):
+                values['navzen-li-result'] = itertools.chain(items, [pager])
+
+            path = os.path.join(self.a['outputDirectory'], self.getIndexPageName(number))
+            index = open(getTempPath(path), "w")
+            template.stream(index, values)
+            index.close()
+            commitFile(index.name, path)
+            self.addToArchive([path])
+
+        # Pages left over from a bigger index
+        number = len(pages) + 1
+        while os.path.isfile(os.path.join(self.a['outputDirectory'], self.getIndexPageName(number))):
+            os.remove(os.path.join(self.a['outputDirectory'], self.getIndexPageName(number)))
+            number += 1
+
+
+    def getIndexPageName(self, number):
+        if number == 1:
+            return INDEX_PAGE_NAME
+        return "{0}-{1}.html".format(os.path.splitext(INDEX_PAGE_NAME)[0], number)
+
+
+    def getIndexPager(self, number, total):
+        if total == 1:
+            return ""
+        links = []
+        for page in range(1, total + 1):
+            if page == number:
+                links.append("<span class='current'>{0}</span>".format(page))
+            else:
+                links.append("<a href='{0}'>{1}</a>".format(self.getIndexPageName(page), page))
+        return "\n            <li class='pager'>{0}</li>\n".format(" ".join(links))
+
 
-            dataTags = self.taggy(os.path.basename(psd))
+    def getIndexEntry(self, psd):
+        """(dataTags, thumb, href) of the index entry for psd."""
+        # While serving, auto formats are only picked once a file is
+        # requested; the server redirects the thumb to its real name
+        if self.server is not None and self.a['outputformat'] == 'auto' and psd not in self.formats:
+            outputFormat = 'png'
+        else:
+            outputFormat = self.getOutputFormat(psd)
+        return (
+            self.taggy(os.path.basename(psd)),
+            "{0}_thumb.{1}".format(
+                os.path.splitext(os.path.basename(psd))[0],
+                outputFormat
+            ),
+            self.changeExtension(os.path.basename(psd), 'html')
+        )
 
-            spans = dataTags.split(" ")
-            htmlSpans = ""
-            for s in spans:
-                htmlSpans += "\
+
+    def getIndexItem(self, dataTags, thumb, href):
+
+        spans = dataTags.split(" ")
+        htmlSpans = ""
+        for s in spans:
+            htmlSpans += "\
             \n<span>"+s+"</span>"
 
-            indexPageLinks += "\n\
+        return "\n\
             <!-- ITEM -->\n\
             <li>\n\
                 <div class='result-box' data-tag='{0}'>\n\
@@ -450,29 +2984,14 @@ class Navzen(object):
                     </div>\n\
                 </div>\n\
             </li>\n".format(
-                dataTags,
-
-                "{0}_thumb.{1}".format(
-                    os.path.splitext(os.path.basename(psd))[0],
-                    self.a['outputformat']
-                ),
-
-                htmlSpans,
+            dataTags,
 
-                self.changeExtension(os.path.basename(psd), 'html')
-            )
+            thumb,
 
-        # Replace custom tags with real content
-        index_html = self.loadTemplate(INDEX_HTML_SHEET)
-        tags = index_html
-        tags = tags.replace("[navzen-title]", "TITULO")
-        tags = tags.replace("[navzen-li-result]", indexPageLinks)
-        index_html = tags
+            htmlSpans,
 
-        index = open(os.path.join(self.a['outputDirectory'], INDEX_PAGE_NAME), "w")
-
-        index.write(index_html)
-        index.close()
+            href
+        )
 
 
     def taggy(self, fn):
@@ -489,15 +3008,8 @@ class Navzen(object):
 
 
     def getSideFile(self, filePath, side):
-        dirName = os.path.dirname(filePath)
-        fileName = os.path.basename(filePath)
-        allFiles = self.getFilesFromDirectory(os.path.dirname(filePath), self.a['inputformat'])
-
-        try:
-            sideFile = allFiles[allFiles.index(filePath)+(side)]
-            return sideFile
-        except:
-            return allFiles[0]
+        fileIndex = self.getFileIndex(os.path.dirname(filePath), self.a['inputformat'])
+        return fileIndex.getSide(filePath, side)
 
 
     def getAllPsds(self, directory):
@@ -513,61 +3025,35 @@ class Navzen(object):
 
 
     def getFilesFromDirectory(self, directory, extension):
-        extSize = len(extension)
+        return list(self.getFileIndex(directory, extension).files)
 
-        try:
 
-            return [ os.path.join(directory, file) for file in os.listdir(directory) if os.path.isfile(os.path.join(directory, file)) and file[extSize*-1:] == extension]
-        except:
-            self.errprint("No existen archivos tipo {0} en el directorio {1}".format(extension, directory))
+    def getFileIndex(self, directory, extension):
+        """Scans each directory once per build and reuses the result."""
+        key = (os.path.normpath(directory), extension)
+        if key not in self.fileIndexes:
+            try:
+                self.fileIndexes[key] = FileIndex(directory, extension)
+            except OSError:
+                self.errprint("No existen archivos tipo {0} en el directorio {1}".format(extension, directory))
+        return self.fileIndexes[key]
 
 
     def copyLibrarys(self):
-        shutil.copy("{0}/previz.js".format(CONFIG_DIR_PATH), self.a['outputDirectory'])
-        shutil.copy("{0}/jquery.js".format(CONFIG_DIR_PATH), self.a['outputDirectory'])
+        linkFile("{0}/previz.js".format(CONFIG_DIR_PATH), os.path.join(self.a['outputDirectory'], "previz.js"))
+        linkFile("{0}/jquery.js".format(CONFIG_DIR_PATH), os.path.join(self.a['outputDirectory'], "jquery.js"))
+        self.addToArchive([os.path.join(self.a['outputDirectory'], "previz.js"), os.path.join(self.a['outputDirectory'], "jquery.js")])
 
 
-    def getImageSize(self, fname):
-        """Determines the image type of fhandle and return its size."""
-        fhandle = open(fname, 'rb')
-        ext = os.path.splitext(fname)[1]
-
-        if ext == ".psd":
-            fhandle.read(14)
-            height, width = struct.unpack("!LL", fhandle.read(8))
-            fhandle.close()
-        else:
-            head = fhandle.read(24)
-            if len(head) != 24:
-                return
-            if imghdr.what(fname) == 'png':
-                check = struct.unpack('>i', head[4:8])[0]
-                if check != 0x0d0a1a0a:
-                    return
-                width, height = struct.unpack('>ii', head[16:24])
-            elif imghdr.what(fname) == 'gif':
-                width, height = struct.unpack('<HH', head[6:10])
-            elif imghdr.what(fname) == 'jpeg':
-                try:
-                    fhandle.seek(0) # Read 0xff next
-                    size = 2
-                    ftype = 0
-                    while not 0xc0 <= ftype <= 0xcf:
-                        fhandle.seek(size, 1)
-                        byte = fhandle.read(1)
-                        while ord(byte) == 0xff:
-                                byte = fhandle.read(1)
-                                ftype = ord(byte)
-                                size = struct.unpack('>H', fhandle.read(2))[0] - 2
-                    # We are at a SOFn block
-                    fhandle.seek(1, 1)  # Skip `precision' byte.
-                    height, width = struct.unpack('>HH', fhandle.read(4))
-                except Exception: #IGNORE:W0703
-                    return
-            else:
-                return
+    def addToArchive(self, paths):
+        if self.archive is not None:
+            for path in paths:
+                self.archive.add(path)
 
-        return width, height
+
+    def getImageSize(self, fname):
+        """Determines the image type of fname and return its size."""
+        return self.probe.getSize(fname)
 
 
     def changeExtension(self, filePath, extension):
@@ -578,8 +3064,57 @@ class Navzen(object):
         print("\nERROR:", msg, end='\n', file=sys.stderr)
         sys.exit()
 
-args = docopt(__doc__, version='Nav 1.0')
-#args = docopt(__doc__, argv="create /Users/hisco/Desktop/project")
+def main():
+    # docopt is all --help and --version need, the build machinery is only
+    # touched once a command runs
+    from docopt import docopt
+    args = docopt(__doc__, version='Nav 1.0')
+    #args = docopt(__doc__, argv="create /Users/hisco/Desktop/project")
+
+    # Argumentos
+
+    navzen = Navzen()
+    navzen.a = {
+        'title': 'Navzen',
+        'psdFile': args["<src>"],
+        'outputDirectory': args["<dst>"],
+        'inputformat': args['--inputformat'],
+        'outputformat': args['--outputformat'],
+        'quality': args["--quality"],
+        'resize': args["--resize"],
+        'crop': '100%',
+        'mobile': args["--mobile"],
+        'sliceSize': 1000,
+        'jobs': args["--jobs"],
+        'force': args["--force"],
+        'backend': args["--backend"],
+        'batch': args["--batch"],
+        'indexPageSize': args["--index-page-size"],
+        'recursive': args["--recursive"],
+        'cacheDirectory': args["--cache-dir"],
+        'cacheSize': args["--cache-size"],
+        'profile': args["--profile"],
+        'srcset': args["--srcset"],
+        'archive': args["--archive"],
+        'archiveOnly': args["--archive-only"],
+        'port': args["--port"],
+        'quiet': False,
+        'kiet': False
+    }
+
+
+    if args['create']:
+        navzen.export('create')
+
+    if args['watch']:
+        navzen.export('watch')
+
+    if args['serve']:
+        navzen.export('serve')
+
+    if args['set']:
+        pass
+
 
 def errprint(msg):
     """Custom error printing."""
@@ -587,24 +3122,5 @@ def errprint(msg):
     sys.exit()
 
 
-# Argumentos
-
-navzen = Navzen()
-navzen.a = {
-    'title': 'Navzen',
-    'psdFile': args["<src>"],
-    'outputDirectory': args["<dst>"],
-    'inputformat': args['--inputformat'],
-    'outputformat': args['--outputformat'],
-    'quality': args["--quality"],
-    'resize': args["--resize"],
-    'crop': '100%',
-    'mobile': args["--mobile"]
-}
-
-
-if args['create']:
-    navzen.export('create')
-
-if args['set']:
-    pass
+if __name__ == '__main__':
+    main()